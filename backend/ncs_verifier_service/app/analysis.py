@@ -0,0 +1,405 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pytesseract
+
+from app.config import settings
+from app.models import AnalysisMetrics, AnalysisResult, AnalysisSummary
+from app.pipeline.frame import FrameContext
+from app.pipeline.match import MatchCandidate, prepare_reference
+from app.pipeline.ocr import OCREngine, OCRResult, create_ocr_engine, ocr_quality_score, run_ocr, run_zone_ocr
+from app.pipeline.quality import assess_quality, recapture_hints
+from app.pipeline.rectify import rectify_document
+from app.pipeline.score import compute_scores
+from app.pipeline.tamper import Finding, TamperResult, analyze_layout, analyze_typography, combine_tamper
+from app.reference_cache import match_frame, reference_cache, reference_moments
+from app.storage.db import get_cached_result, list_references, put_cached_result, reference_set_stamp
+
+logger = logging.getLogger("ncs_verifier")
+
+ProgressCallback = Callable[[str, int], None]
+
+# Stage -> (session status, percent) reported when the stage starts.
+_STAGE_PROGRESS: Dict[str, Tuple[str, int]] = {
+    "match": ("matching", 35),
+    "ocr": ("ocr", 55),
+    "layout": ("tamper", 75),
+    "typography": ("tamper", 75),
+}
+
+_stage_executor: Optional[ThreadPoolExecutor] = None
+_stage_executor_lock = threading.Lock()
+_ocr_engine: Optional[OCREngine] = None
+_ocr_engine_lock = threading.Lock()
+_ocr_tile_executor: Optional[ThreadPoolExecutor] = None
+_snapshots: "OrderedDict[Tuple[Optional[str], Optional[str]], ReferenceSnapshot]" = OrderedDict()
+_snapshot_lock = threading.Lock()
+_MAX_SNAPSHOTS = 16
+# Any setting can change a result, so all of them go into the result cache key.
+_CONFIG_STAMP = hashlib.sha256(json.dumps(settings.model_dump(), sort_keys=True, default=str).encode()).hexdigest()
+
+
+class AnalysisError(Exception):
+    """A frame that cannot be analysed; carries the HTTP status, response detail and a short status message."""
+
+    def __init__(self, status_code: int, detail: Any, message: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.message = message
+
+
+@dataclass
+class FrameAnalysis:
+    result: AnalysisResult
+    match: Optional[MatchCandidate]
+    timings_ms: Dict[str, float] = field(default_factory=dict)
+    cached: bool = False
+
+
+@dataclass
+class ReferenceSnapshot:
+    """The references a frame is matched against, read once so many frames can share one view."""
+
+    rows: List[dict]
+    stamp: str
+    field_zones: bool = field(init=False)
+
+    def __post_init__(self) -> None:
+        # Whether any reference declares ``field_zones``; only then does OCR wait for the match.
+        self.field_zones = any(json.loads(row["metadata"]).get("field_zones") for row in self.rows)
+
+
+@dataclass
+class FrameLookup:
+    """A frame's reference snapshot and result-cache lookup, done before the frame takes a pipeline slot.
+
+    ``cache_key`` is None when the result cache is off; ``cached`` holds the stored result on a hit.
+    """
+
+    snapshot: ReferenceSnapshot
+    cache_key: Optional[str] = None
+    cached: Optional[FrameAnalysis] = None
+
+
+def reference_snapshot(doc_type: Optional[str] = None, version: Optional[str] = None) -> ReferenceSnapshot:
+    """The current references for these filters, re-listed only when ``reference_set_stamp`` changes."""
+    stamp = reference_set_stamp()
+    key = (doc_type, version)
+    with _snapshot_lock:
+        snapshot = _snapshots.get(key)
+        if snapshot is not None and snapshot.stamp == stamp:
+            _snapshots.move_to_end(key)
+            return snapshot
+    snapshot = ReferenceSnapshot(rows=list_references(doc_type, version), stamp=stamp)
+    with _snapshot_lock:
+        _snapshots[key] = snapshot
+        _snapshots.move_to_end(key)
+        while len(_snapshots) > _MAX_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+    return snapshot
+
+
+class _Progress:
+    """Forwards stage progress to a callback, never letting the reported percent go backwards."""
+
+    def __init__(self, callback: Optional[ProgressCallback]) -> None:
+        self._callback = callback
+        self._percent = -1
+        self._lock = threading.Lock()
+
+    def report(self, status: str, percent: int) -> None:
+        if self._callback is None:
+            return
+        with self._lock:
+            if percent <= self._percent:
+                return
+            self._percent = percent
+            self._callback(status, percent)
+
+
+def _get_stage_executor() -> ThreadPoolExecutor:
+    global _stage_executor
+    with _stage_executor_lock:
+        if _stage_executor is None:
+            _stage_executor = ThreadPoolExecutor(
+                max_workers=max(1, settings.pipeline_workers), thread_name_prefix="stage"
+            )
+        return _stage_executor
+
+
+def get_ocr_engine() -> OCREngine:
+    """Process-wide OCR engine selected by ``settings.ocr_engine``, created (and warmed) once."""
+    global _ocr_engine
+    with _ocr_engine_lock:
+        if _ocr_engine is None:
+            _ocr_engine = create_ocr_engine(settings.ocr_engine, settings.ocr_pool_size)
+            logger.info("ocr_engine_ready %s", json.dumps({"engine": _ocr_engine.name}))
+        return _ocr_engine
+
+
+def _get_ocr_tile_executor() -> Optional[ThreadPoolExecutor]:
+    # Separate from the stage pool: the OCR stage waits on its tiles from a stage worker.
+    global _ocr_tile_executor
+    if settings.ocr_tiles <= 1:
+        return None
+    with _ocr_engine_lock:
+        if _ocr_tile_executor is None:
+            _ocr_tile_executor = ThreadPoolExecutor(max_workers=settings.ocr_tiles, thread_name_prefix="ocr")
+        return _ocr_tile_executor
+
+
+def result_cache_key(
+    image: np.ndarray,
+    doc_type: Optional[str],
+    version: Optional[str],
+    reference_stamp: Optional[str] = None,
+) -> str:
+    """Key of a frame's result: decoded pixels, request filters, reference set and configuration."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps([image.shape, str(image.dtype), doc_type, version]).encode())
+    digest.update(np.ascontiguousarray(image).data)
+    digest.update((reference_stamp or reference_set_stamp()).encode())
+    digest.update(_CONFIG_STAMP.encode())
+    return digest.hexdigest()
+
+
+def lookup_frame(
+    image: np.ndarray,
+    doc_type: Optional[str] = None,
+    version: Optional[str] = None,
+    snapshot: Optional[ReferenceSnapshot] = None,
+) -> FrameLookup:
+    """Hash ``image`` and look its result up, so callers can answer repeated frames without the pipeline."""
+    lookup = FrameLookup(snapshot=snapshot or reference_snapshot(doc_type, version))
+    if settings.result_cache_ttl_seconds > 0:
+        lookup.cache_key = result_cache_key(image, doc_type, version, lookup.snapshot.stamp)
+        cached = get_cached_result(lookup.cache_key, settings.result_cache_ttl_seconds)
+        if cached is not None:
+            lookup.cached = FrameAnalysis(result=AnalysisResult.model_validate(cached), match=None, cached=True)
+    return lookup
+
+
+def _run_stages(
+    stages: Dict[str, Tuple[Callable[..., Any], List[str]]],
+    progress: _Progress,
+    timings_ms: Dict[str, float],
+) -> Dict[str, Any]:
+    """Run a small dependency graph of stages, each on the stage pool as soon as its inputs are ready.
+
+    ``stages`` maps a name to ``(fn, dependencies)``; ``fn`` is called with the results of
+    its dependencies in order. Scheduling stays on the calling thread so a stage never
+    blocks a pool worker waiting on another one. The first stage error is re-raised.
+    """
+    executor = _get_stage_executor()
+    results: Dict[str, Any] = {}
+    pending = dict(stages)
+    running: Dict[Future, str] = {}
+
+    def timed(name: str, fn: Callable[..., Any], *args: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings_ms[name] = round((time.perf_counter() - started) * 1000.0, 2)
+
+    while pending or running:
+        for name, (fn, dependencies) in list(pending.items()):
+            if all(dependency in results for dependency in dependencies):
+                del pending[name]
+                progress.report(*_STAGE_PROGRESS[name])
+                args = [results[dependency] for dependency in dependencies]
+                running[executor.submit(timed, name, fn, *args)] = name
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[running.pop(future)] = future.result()
+    return results
+
+
+def analyze_frame(
+    image: np.ndarray,
+    doc_type: Optional[str] = None,
+    version: Optional[str] = None,
+    progress: Optional[ProgressCallback] = None,
+    snapshot: Optional[ReferenceSnapshot] = None,
+    lookup: Optional[FrameLookup] = None,
+) -> FrameAnalysis:
+    """Run the verification pipeline on one decoded frame.
+
+    After rectification the stages form a small graph: matching feeds the layout and
+    watermark checks, OCR feeds the typography check, and the two chains run
+    concurrently, so latency tracks the slower chain rather than the sum of stages.
+    When ``settings.ocr_field_zones`` is on and some candidate reference declares
+    ``field_zones``, OCR waits for the match instead so that only those crops are read.
+
+    Results are cached by ``result_cache_key``; a repeated frame returns the stored
+    result without running any stage. Callers that looked the frame up already pass
+    that ``lookup_frame`` result as ``lookup``. Frames failing the quality gate are
+    rejected before rectification, or in ``"degraded"`` mode are only rectified and
+    matched. References come from ``snapshot`` (by default ``reference_snapshot`` for
+    the same filters), so the reference set is only re-listed after it changes.
+    """
+    lookup = lookup or lookup_frame(image, doc_type, version, snapshot)
+    if lookup.cached is not None:
+        return lookup.cached
+    snapshot = lookup.snapshot
+    cache_key = lookup.cache_key
+
+    tracker = _Progress(progress)
+    timings_ms: Dict[str, float] = {}
+    raw = FrameContext(image)
+    quality = assess_quality(image, context=raw)
+    hints = recapture_hints(quality, settings.quality_min_blur, settings.quality_max_glare)
+    if hints and settings.quality_gate == "reject":
+        raise AnalysisError(
+            422,
+            {
+                "code": "frame_quality",
+                "message": "Frame quality too low; please re-capture",
+                "quality": asdict(quality),
+                "hints": hints,
+            },
+            "Frame quality too low; please re-capture",
+        )
+    degraded = bool(hints) and settings.quality_gate == "degraded"
+
+    rectified = rectify_document(
+        image,
+        detect_max_side=settings.rectify_max_side,
+        refine_corners=settings.rectify_refine_corners,
+        context=raw,
+    )
+    if not rectified.success:
+        raise AnalysisError(
+            422, "Unable to detect document boundary; please hold steady", "Could not detect document edges"
+        )
+    frame = rectified.image
+    page = FrameContext(frame, warp=rectified.warp)
+    rows = snapshot.rows
+
+    def matched_row(match_candidate: Optional[MatchCandidate]) -> Optional[dict]:
+        if not match_candidate:
+            return None
+        return next(row for row in rows if row["id"] == match_candidate.reference_id)
+
+    def layout(match_candidate: Optional[MatchCandidate]) -> TamperResult:
+        reference = None
+        metadata: dict = {}
+        row = matched_row(match_candidate)
+        if row:
+            reference = reference_cache.load(row)
+            metadata = json.loads(row["metadata"])
+        if reference is not None:
+            reference = replace(reference, moments=reference_moments(row["id"], reference))
+        else:
+            reference = prepare_reference(frame)
+        return analyze_layout(
+            frame,
+            reference,
+            metadata,
+            mode=settings.tamper_mode,
+            min_cell=settings.tamper_min_cell,
+            time_budget_ms=settings.tamper_time_budget_ms,
+            context=page,
+        )
+
+    zone_ocr = settings.ocr_field_zones and snapshot.field_zones
+
+    def matched_field_zones(match_candidate: Optional[MatchCandidate]) -> Optional[Dict[str, Any]]:
+        row = matched_row(match_candidate) if zone_ocr else None
+        return json.loads(row["metadata"]).get("field_zones") if row else None
+
+    def ocr(match_candidate: Optional[MatchCandidate] = None) -> OCRResult:
+        field_zones = matched_field_zones(match_candidate)
+        if field_zones:
+            return run_zone_ocr(frame, field_zones, get_ocr_engine())
+        return run_ocr(
+            frame,
+            get_ocr_engine(),
+            tiles=settings.ocr_tiles,
+            overlap=settings.ocr_tile_overlap,
+            executor=_get_ocr_tile_executor(),
+        )
+
+    def match() -> Optional[MatchCandidate]:
+        return match_frame(frame, rows, context=page)
+
+    def typography(ocr_result: OCRResult) -> TamperResult:
+        return analyze_typography([word.bbox for word in ocr_result.words])
+
+    stages: Dict[str, Tuple[Callable[..., Any], List[str]]] = {"match": (match, [])}
+    if not degraded:
+        stages["ocr"] = (ocr, ["match"] if zone_ocr else [])
+        stages["layout"] = (layout, ["match"])
+        stages["typography"] = (typography, ["ocr"])
+    try:
+        outputs = _run_stages(stages, tracker, timings_ms)
+    except pytesseract.pytesseract.TesseractNotFoundError as exc:
+        raise AnalysisError(500, "Tesseract OCR not installed", "Tesseract OCR not installed") from exc
+
+    match_candidate: Optional[MatchCandidate] = outputs["match"]
+    if degraded:
+        ocr_result = OCRResult(full_text="", words=[], extracted_fields={})
+        skipped = Finding(
+            category="quality",
+            severity="medium",
+            message="Frame quality too low; OCR and tamper checks were skipped",
+            bbox=[0, 0, int(frame.shape[1]), int(frame.shape[0])],
+            score=0.0,
+        )
+        tamper = TamperResult(findings=[skipped], tamper_score=0.0)
+    else:
+        ocr_result = outputs["ocr"]
+        tamper = combine_tamper(outputs["layout"], outputs["typography"])
+    match_score = match_candidate.score if match_candidate else 0.0
+    reference_id = match_candidate.reference_id if match_candidate else None
+    ocr_quality = ocr_quality_score(ocr_result, matched_field_zones(match_candidate))
+
+    tracker.report("scoring", 90)
+    scores = compute_scores(match_score, ocr_quality, tamper.tamper_score, quality, degraded=degraded)
+
+    summary = AnalysisSummary(
+        doc_type_guess=doc_type,
+        reference_id=reference_id,
+        match_score=scores.template_match_score,
+        tamper_risk_score=scores.tamper_risk_score,
+        confidence_band=scores.confidence_band,
+        disclaimer=(
+            "Offline verification against reference templates provides a risk assessment, "
+            "not proof of official issuance."
+        ),
+    )
+
+    metrics = AnalysisMetrics(
+        template_match_score=scores.template_match_score,
+        ocr_quality_score=scores.ocr_quality_score,
+        tamper_risk_score=scores.tamper_risk_score,
+        quality_metrics={
+            "blur_score": quality.blur_score,
+            "glare_ratio": quality.glare_ratio,
+            "acceptable": quality.acceptable,
+        },
+    )
+
+    result = AnalysisResult(
+        summary=summary,
+        metrics=metrics,
+        extracted_fields=ocr_result.extracted_fields,
+        ocr_text=ocr_result.full_text,
+        findings=[finding.__dict__ for finding in tamper.findings],
+    )
+    if cache_key is not None:
+        put_cached_result(
+            cache_key, result.model_dump(), settings.result_cache_ttl_seconds, settings.result_cache_max_entries
+        )
+    return FrameAnalysis(result=result, match=match_candidate, timings_ms=timings_ms)
@@ -1,39 +1,46 @@
 from __future__ import annotations
 
+import asyncio
+import io
 import json
 import logging
 import os
+import tarfile
+import time
 import uuid
+import zipfile
+from dataclasses import asdict
 from datetime import datetime
+from typing import Any, AsyncIterator, Callable, List, Optional, Set, Tuple, TypeVar
 
 import cv2
 import numpy as np
-import pytesseract
 from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 
+from app.analysis import AnalysisError, FrameLookup, ReferenceSnapshot, analyze_frame, lookup_frame, reference_snapshot
 from app.config import settings
+from app.executor import QueueFullError, pipeline_executor
 from app.models import (
-    AnalysisMetrics,
-    AnalysisResult,
-    AnalysisSummary,
+    BatchItemResult,
+    BatchSummary,
+    PipelineStats,
     ReferenceList,
     ReferenceRead,
     VerifyResponse,
 )
-from app.pipeline.match import match_reference
-from app.pipeline.ocr import run_ocr
-from app.pipeline.quality import assess_quality
-from app.pipeline.rectify import rectify_document
-from app.pipeline.score import compute_scores
-from app.pipeline.tamper import analyze_tamper
+from app.reference_cache import register_reference
 from app.storage.db import add_audit_log, add_reference, get_reference, list_references
 
 logger = logging.getLogger("ncs_verifier")
 router = APIRouter()
+T = TypeVar("T")
 
+_BATCH_ADMISSION_POLL_SECONDS = 0.1
 
-def _load_image(file: UploadFile) -> np.ndarray:
-    data = file.file.read()
+
+def _decode_image(data: bytes) -> np.ndarray:
     if not data:
         raise HTTPException(status_code=400, detail="Empty image upload")
     image_array = np.frombuffer(data, dtype=np.uint8)
@@ -47,6 +54,19 @@ def _reference_dir(ref_id: str) -> str:
     return os.path.join(settings.data_dir, "references", ref_id)
 
 
+async def _run_pipeline(fn: Callable[..., T], *args: Any) -> T:
+    """Run CPU-bound work on the bounded pipeline executor; 429 with Retry-After when it is full."""
+    try:
+        return await pipeline_executor.run(fn, *args)
+    except QueueFullError as exc:
+        logger.warning("pipeline_queue_full %s", json.dumps(pipeline_executor.stats()))
+        raise HTTPException(
+            status_code=429,
+            detail="Verification queue is full; please retry",
+            headers={"Retry-After": str(exc.retry_after)},
+        ) from exc
+
+
 @router.post("/v1/references", response_model=ReferenceRead)
 async def create_reference(
     doc_type: str = Form(...),
@@ -60,31 +80,36 @@ async def create_reference(
     except json.JSONDecodeError as exc:
         raise HTTPException(status_code=400, detail="metadata must be valid JSON") from exc
 
+    data = await file.read()
+    created_at = await _run_pipeline(_store_reference, ref_id, doc_type, version, meta_dict, data)
+    return ReferenceRead(
+        id=ref_id,
+        doc_type=doc_type,
+        version=version,
+        metadata=meta_dict,
+        created_at=created_at,
+    )
+
+
+def _store_reference(ref_id: str, doc_type: str, version: str, meta_dict: dict, data: bytes) -> str:
+    image = _decode_image(data)
     ref_dir = _reference_dir(ref_id)
     os.makedirs(ref_dir, exist_ok=True)
     image_path = os.path.join(ref_dir, "original.jpg")
-
-    image = _load_image(file)
     cv2.imwrite(image_path, image)
 
     add_reference(ref_id, doc_type, version, meta_dict, image_path)
+    register_reference(ref_id, image)
     logger.info("reference_created %s", json.dumps({"reference_id": ref_id}))
 
     row = get_reference(ref_id)
-    created_at = row["created_at"] if row else datetime.utcnow().isoformat()
-    return ReferenceRead(
-        id=ref_id,
-        doc_type=doc_type,
-        version=version,
-        metadata=meta_dict,
-        created_at=created_at,
-    )
+    return row["created_at"] if row else datetime.utcnow().isoformat()
 
 
 @router.get("/v1/references", response_model=ReferenceList)
-async def list_reference() -> ReferenceList:
+def list_reference(doc_type: str | None = None, version: str | None = None) -> ReferenceList:
     items = []
-    for row in list_references():
+    for row in list_references(doc_type, version):
         items.append(
             ReferenceRead(
                 id=row["id"],
@@ -98,7 +123,7 @@ async def list_reference() -> ReferenceList:
 
 
 @router.get("/v1/references/{ref_id}", response_model=ReferenceRead)
-async def get_reference_by_id(ref_id: str) -> ReferenceRead:
+def get_reference_by_id(ref_id: str) -> ReferenceRead:
     row = get_reference(ref_id)
     if not row:
         raise HTTPException(status_code=404, detail="Reference not found")
@@ -115,83 +140,187 @@ async def get_reference_by_id(ref_id: str) -> ReferenceRead:
 async def verify_document(
     file: UploadFile = File(...),
     doc_type: str | None = Form(None),
+    version: str | None = Form(None),
 ) -> VerifyResponse:
-    image = _load_image(file)
-    quality = assess_quality(image)
+    data = await file.read()
+    image, lookup = await run_in_threadpool(_lookup, data, doc_type, version)
+    # Only result-cache misses take a pipeline slot.
+    if lookup.cached is not None:
+        return await run_in_threadpool(_verify, image, doc_type, version, lookup)
+    return await _run_pipeline(_verify, image, doc_type, version, lookup)
 
-    rectified = rectify_document(image)
-    if not rectified.success:
-        raise HTTPException(status_code=422, detail="Unable to detect document boundary; please hold steady")
 
-    references = []
-    for row in list_references():
-        ref_image = cv2.imread(row["image_path"])
-        if ref_image is not None:
-            references.append((row["id"], ref_image))
+def _lookup(
+    data: bytes,
+    doc_type: Optional[str],
+    version: Optional[str],
+    snapshot: Optional[ReferenceSnapshot] = None,
+) -> Tuple[np.ndarray, FrameLookup]:
+    image = _decode_image(data)
+    return image, lookup_frame(image, doc_type, version, snapshot)
 
-    match_candidate = match_reference(rectified.image, references) if references else None
-    match_score = match_candidate.score if match_candidate else 0.0
-    reference_id = match_candidate.reference_id if match_candidate else None
 
+def _verify(image: np.ndarray, doc_type: Optional[str], version: Optional[str], lookup: FrameLookup) -> VerifyResponse:
     try:
-        ocr_result = run_ocr(rectified.image)
-    except pytesseract.pytesseract.TesseractNotFoundError as exc:
-        raise HTTPException(status_code=500, detail="Tesseract OCR not installed") from exc
-
-    ocr_quality_score = float(min(100.0, len(ocr_result.words) * 1.5))
-
-    reference_image = None
-    reference_metadata: dict = {}
-    if reference_id:
-        row = get_reference(reference_id)
-        if row:
-            reference_image = cv2.imread(row["image_path"])
-            reference_metadata = json.loads(row["metadata"])
-
-    if reference_image is None:
-        reference_image = rectified.image
-    tamper = analyze_tamper(
-        rectified.image,
-        reference_image,
-        reference_metadata,
-        [word.bbox for word in ocr_result.words],
-    )
+        analysis = analyze_frame(image, doc_type, version, lookup=lookup)
+    except AnalysisError as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail) from exc
+    result = analysis.result
+    match_candidate = analysis.match
+    reference_id = result.summary.reference_id
 
-    scores = compute_scores(match_score, ocr_quality_score, tamper.tamper_score, quality)
-
-    summary = AnalysisSummary(
-        doc_type_guess=doc_type,
-        reference_id=reference_id,
-        match_score=scores.template_match_score,
-        tamper_risk_score=scores.tamper_risk_score,
-        confidence_band=scores.confidence_band,
-        disclaimer=(
-            "Offline verification against reference templates provides a risk assessment, "
-            "not proof of official issuance."
+    audit_id = str(uuid.uuid4())
+    add_audit_log(audit_id, doc_type, reference_id, result.model_dump())
+    match_levels = [asdict(level) for level in match_candidate.levels] if match_candidate else []
+    logger.info(
+        "verification_completed %s",
+        json.dumps(
+            {
+                "audit_id": audit_id,
+                "reference_id": reference_id,
+                "cached": analysis.cached,
+                "match_levels": match_levels,
+                "stage_ms": analysis.timings_ms,
+            }
         ),
     )
 
-    metrics = AnalysisMetrics(
-        template_match_score=scores.template_match_score,
-        ocr_quality_score=scores.ocr_quality_score,
-        tamper_risk_score=scores.tamper_risk_score,
-        quality_metrics={
-            "blur_score": quality.blur_score,
-            "glare_ratio": quality.glare_ratio,
-            "acceptable": quality.acceptable,
-        },
+    return VerifyResponse(result=result, audit_id=audit_id)
+
+
+def _skip_member(name: str) -> bool:
+    return name.startswith("__MACOSX/") or os.path.basename(name).startswith(".")
+
+
+def _expand_batch(uploads: List[Tuple[str, bytes]]) -> List[Tuple[str, bytes]]:
+    """Flatten uploads into ``(name, bytes)`` documents, unpacking zip and tar archives."""
+    documents: List[Tuple[str, bytes]] = []
+
+    def add(name: str, size: int, read: Callable[[], bytes]) -> None:
+        if len(documents) >= settings.batch_max_documents:
+            raise HTTPException(status_code=413, detail=f"Batch exceeds {settings.batch_max_documents} documents")
+        if size > settings.batch_max_document_bytes:
+            raise HTTPException(status_code=413, detail=f"{name} exceeds {settings.batch_max_document_bytes} bytes")
+        documents.append((name, read()))
+
+    for filename, data in uploads:
+        buffer = io.BytesIO(data)
+        if zipfile.is_zipfile(buffer):
+            with zipfile.ZipFile(buffer) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and not _skip_member(info.filename):
+                        add(f"{filename}/{info.filename}", info.file_size, lambda: archive.read(info))
+            continue
+        buffer.seek(0)
+        if data and tarfile.is_tarfile(buffer):
+            buffer.seek(0)
+            with tarfile.open(fileobj=buffer, mode="r:*") as archive:
+                for member in archive.getmembers():
+                    if member.isfile() and not _skip_member(member.name):
+                        add(f"{filename}/{member.name}", member.size, lambda: archive.extractfile(member).read())
+            continue
+        add(filename, len(data), lambda: data)
+    return documents
+
+
+def _verify_batch_item(
+    filename: str,
+    data: bytes,
+    doc_type: Optional[str],
+    version: Optional[str],
+    snapshot: ReferenceSnapshot,
+) -> BatchItemResult:
+    try:
+        image, lookup = _lookup(data, doc_type, version, snapshot)
+        response = _verify(image, doc_type, version, lookup)
+    except HTTPException as exc:
+        return BatchItemResult(filename=filename, status=exc.status_code, detail=exc.detail)
+    except Exception:
+        logger.exception("batch_item_failed %s", json.dumps({"filename": filename}))
+        return BatchItemResult(filename=filename, status=500, detail="Verification failed")
+    return BatchItemResult(filename=filename, status=200, audit_id=response.audit_id, result=response.result)
+
+
+async def _stream_batch(
+    batch_id: str,
+    documents: List[Tuple[str, bytes]],
+    doc_type: Optional[str],
+    version: Optional[str],
+    snapshot: ReferenceSnapshot,
+) -> AsyncIterator[str]:
+    """Feed documents through ``pipeline_executor`` and yield each result line as it finishes.
+
+    At most ``batch_concurrency`` documents of the batch are admitted at once. When the
+    executor refuses one, the batch waits for one of its own documents to finish (or
+    polls, if none is in flight) instead of failing, so batches share admission control
+    with single requests and leave the rest of the queue to them.
+    """
+    started = time.perf_counter()
+    window = settings.batch_concurrency or pipeline_executor.workers
+    pending: Set["asyncio.Future[BatchItemResult]"] = set()
+    submitted = 0
+    succeeded = 0
+    try:
+        while submitted < len(documents) or pending:
+            if submitted < len(documents) and len(pending) < window:
+                filename, data = documents[submitted]
+                try:
+                    pending.add(
+                        pipeline_executor.submit(_verify_batch_item, filename, data, doc_type, version, snapshot)
+                    )
+                except QueueFullError:
+                    if not pending:
+                        await asyncio.sleep(_BATCH_ADMISSION_POLL_SECONDS)
+                        continue
+                else:
+                    submitted += 1
+                    continue
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                item = future.result()
+                succeeded += item.status == 200
+                yield item.model_dump_json() + "\n"
+    finally:
+        # Stop queued documents if the client goes away mid-stream.
+        for future in pending:
+            future.cancel()
+
+    summary = BatchSummary(
+        batch_id=batch_id,
+        documents=len(documents),
+        succeeded=succeeded,
+        failed=len(documents) - succeeded,
+        elapsed_ms=round((time.perf_counter() - started) * 1000.0, 2),
     )
+    logger.info("batch_completed %s", summary.model_dump_json())
+    yield summary.model_dump_json() + "\n"
+
 
-    result = AnalysisResult(
-        summary=summary,
-        metrics=metrics,
-        extracted_fields=ocr_result.extracted_fields,
-        ocr_text=ocr_result.full_text,
-        findings=[finding.__dict__ for finding in tamper.findings],
+@router.post("/v1/verify/batch")
+async def verify_batch(
+    files: List[UploadFile] = File(...),
+    doc_type: str | None = Form(None),
+    version: str | None = Form(None),
+) -> StreamingResponse:
+    """Verify many images, or zip/tar archives of them, streaming one NDJSON line per document as it finishes.
+
+    Documents run concurrently on the pipeline executor (see ``_stream_batch``) and are
+    matched against one reference snapshot taken when the batch starts; a final line
+    summarises the batch.
+    """
+    uploads = [(file.filename or f"file-{index}", await file.read()) for index, file in enumerate(files)]
+    documents = await run_in_threadpool(_expand_batch, uploads)
+    if not documents:
+        raise HTTPException(status_code=400, detail="Batch contains no documents")
+    snapshot = await run_in_threadpool(reference_snapshot, doc_type, version)
+    batch_id = str(uuid.uuid4())
+    logger.info("batch_started %s", json.dumps({"batch_id": batch_id, "documents": len(documents)}))
+    return StreamingResponse(
+        _stream_batch(batch_id, documents, doc_type, version, snapshot),
+        media_type="application/x-ndjson",
     )
 
-    audit_id = str(uuid.uuid4())
-    add_audit_log(audit_id, doc_type, reference_id, result.model_dump())
-    logger.info("verification_completed %s", json.dumps({"audit_id": audit_id, "reference_id": reference_id}))
 
-    return VerifyResponse(result=result, audit_id=audit_id)
+@router.get("/v1/pipeline/stats", response_model=PipelineStats)
+def get_pipeline_stats() -> PipelineStats:
+    return PipelineStats(**pipeline_executor.stats())
@@ -6,7 +6,38 @@ class Settings(BaseSettings):
     debug: bool = False
     data_dir: str = "backend/ncs_verifier_service/data"
     database_path: str = "backend/ncs_verifier_service/data/verifier.db"
+    feature_store_path: str = "backend/ncs_verifier_service/data/reference_features.bin"
+    keypoint_index_path: str = "backend/ncs_verifier_service/data/reference_keypoints"
     tesseract_cmd: str | None = None
+    reference_cache_max_bytes: int = 512 * 1024 * 1024
+    reference_moments_cache_max_bytes: int = 256 * 1024 * 1024
+    reference_pyramid_cache_max_bytes: int = 64 * 1024 * 1024
+    match_shortlist_k: int = 20
+    match_engine: str = "ssim"
+    match_pyramid_levels: int = 1
+    match_prune_margin: float = 10.0
+    match_workers: int = 1
+    tamper_mode: str = "grid"
+    tamper_min_cell: int = 24
+    tamper_time_budget_ms: float = 50.0
+    pipeline_workers: int = 4
+    pipeline_concurrency: int = 2
+    pipeline_queue_size: int = 8
+    ocr_engine: str = "auto"
+    ocr_pool_size: int = 2
+    ocr_field_zones: bool = True
+    ocr_tiles: int = 1
+    ocr_tile_overlap: int = 64
+    result_cache_ttl_seconds: int = 3600
+    result_cache_max_entries: int = 1000
+    quality_gate: str = "off"
+    quality_min_blur: float = 30.0
+    quality_max_glare: float = 0.6
+    rectify_max_side: int = 1000
+    rectify_refine_corners: bool = True
+    batch_concurrency: int = 0
+    batch_max_documents: int = 500
+    batch_max_document_bytes: int = 20 * 1024 * 1024
 
     model_config = SettingsConfigDict(env_file=".env", env_prefix="NCS_VERIFIER_")
 
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, TypeVar
+
+from app.config import settings
+
+T = TypeVar("T")
+
+
+class QueueFullError(Exception):
+    """Raised when every worker is busy and the wait queue is full."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Pipeline queue is full")
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """Thread pool for CPU-bound request work that admits at most ``workers + max_queue`` jobs.
+
+    Jobs beyond that are refused with ``QueueFullError`` instead of queueing without limit,
+    so latency stays bounded under load. Queue depth and wait/run times are kept for
+    ``stats``.
+    """
+
+    def __init__(self, workers: int, max_queue: int, name: str = "pipeline") -> None:
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._running = 0
+        self._started = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_ms_total = 0.0
+        self._wait_ms_max = 0.0
+        self._run_ms_total = 0.0
+
+    def _retry_after(self) -> int:
+        average_run_s = self._run_ms_total / self._completed / 1000.0 if self._completed else 1.0
+        return max(1, math.ceil(average_run_s * (self._admitted - self._running + 1) / self.workers))
+
+    def submit(self, fn: Callable[..., T], *args: Any) -> "asyncio.Future[T]":
+        submitted = time.perf_counter()
+        with self._lock:
+            if self._admitted >= self.workers + self.max_queue:
+                self._rejected += 1
+                raise QueueFullError(self._retry_after())
+            self._admitted += 1
+
+        def job() -> T:
+            started = time.perf_counter()
+            with self._lock:
+                self._running += 1
+                self._started += 1
+                wait_ms = (started - submitted) * 1000.0
+                self._wait_ms_total += wait_ms
+                self._wait_ms_max = max(self._wait_ms_max, wait_ms)
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._admitted -= 1
+                    self._completed += 1
+                    self._run_ms_total += (time.perf_counter() - started) * 1000.0
+
+        future = self._pool.submit(job)
+        future.add_done_callback(self._release_cancelled)
+        return asyncio.wrap_future(future)
+
+    def _release_cancelled(self, future: "Future[Any]") -> None:
+        # A job cancelled while queued never runs, so its admission slot is released here.
+        if future.cancelled():
+            with self._lock:
+                self._admitted -= 1
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """Run ``fn(*args)`` on the pool without blocking the event loop."""
+        return await self.submit(fn, *args)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            started, completed = self._started, self._completed
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._admitted - self._running,
+                "completed": completed,
+                "rejected": self._rejected,
+                "wait_ms_avg": round(self._wait_ms_total / started, 2) if started else 0.0,
+                "wait_ms_max": round(self._wait_ms_max, 2),
+                "run_ms_avg": round(self._run_ms_total / completed, 2) if completed else 0.0,
+            }
+
+
+pipeline_executor = BoundedExecutor(settings.pipeline_concurrency, settings.pipeline_queue_size)
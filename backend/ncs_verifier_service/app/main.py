@@ -8,8 +8,10 @@ import pytesseract
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.analysis import get_ocr_engine
 from app.api import router
 from app.config import settings
+from app.reference_cache import warm_reference_cache
 from app.storage.db import init_db
 
 
@@ -43,6 +45,8 @@ def create_app() -> FastAPI:
     @app.on_event("startup")
     def _startup() -> None:
         init_db()
+        warm_reference_cache()
+        get_ocr_engine()
         logging.getLogger("ncs_verifier").info("startup %s", json.dumps({"status": "ready"}))
 
     return app
@@ -65,3 +65,31 @@ class AnalysisResult(BaseModel):
 class VerifyResponse(BaseModel):
     result: AnalysisResult
     audit_id: str
+
+
+class PipelineStats(BaseModel):
+    workers: int
+    max_queue: int
+    running: int
+    queued: int
+    completed: int
+    rejected: int
+    wait_ms_avg: float
+    wait_ms_max: float
+    run_ms_avg: float
+
+
+class BatchItemResult(BaseModel):
+    filename: str
+    status: int
+    audit_id: Optional[str] = None
+    result: Optional[AnalysisResult] = None
+    detail: Optional[Any] = None
+
+
+class BatchSummary(BaseModel):
+    batch_id: str
+    documents: int
+    succeeded: int
+    failed: int
+    elapsed_ms: float
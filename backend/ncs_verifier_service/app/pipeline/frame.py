@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import cv2
+import numpy as np
+
+from app.pipeline.ssim import Moments, local_moments
+
+
+class FrameContext:
+    """Lazily computed, memoized views of one frame, shared by every stage that reads it.
+
+    ``warp(width, height)`` may render the frame at another size straight from its source
+    (see ``RectifyResult.warp``); otherwise sized views are resized from ``image``. Views
+    are computed once even when concurrent stages ask for them at the same time.
+    """
+
+    def __init__(self, image: np.ndarray, warp: Optional[Callable[[int, int], np.ndarray]] = None) -> None:
+        self.image = image
+        self._warp = warp
+        self._views: Dict[Hashable, Any] = {}
+        self._pending: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _memo(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._views:
+                return self._views[key]
+            pending = self._pending.setdefault(key, threading.Lock())
+        with pending:
+            with self._lock:
+                if key in self._views:
+                    return self._views[key]
+            value = compute()
+            with self._lock:
+                self._views[key] = value
+                self._pending.pop(key, None)
+        return value
+
+    @property
+    def gray(self) -> np.ndarray:
+        if self.image.ndim == 2:
+            return self.image
+        return self._memo("gray", lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY))
+
+    def resized_gray(self, width: int, height: int) -> np.ndarray:
+        """Grayscale frame at ``width`` x ``height``."""
+
+        def compute() -> np.ndarray:
+            if (height, width) == self.image.shape[:2]:
+                return self.gray
+            if self._warp is not None:
+                return cv2.cvtColor(self._warp(width, height), cv2.COLOR_BGR2GRAY)
+            shrinking = width * height < self.image.shape[0] * self.image.shape[1]
+            interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+            return cv2.resize(self.gray, (width, height), interpolation=interpolation)
+
+        return self._memo(("gray", width, height), compute)
+
+    def pyramid(self, width: int, height: int, level: int) -> np.ndarray:
+        """``level`` rounds of ``cv2.pyrDown`` applied to ``resized_gray(width, height)``."""
+        if level <= 0:
+            return self.resized_gray(width, height)
+        key = ("pyramid", width, height, level)
+        return self._memo(key, lambda: cv2.pyrDown(self.pyramid(width, height, level - 1)))
+
+    def moments(self, width: int, height: int, level: int = 0) -> Moments:
+        """SSIM ``local_moments`` of ``pyramid(width, height, level)``."""
+        return self._memo(("moments", width, height, level), lambda: local_moments(self.pyramid(width, height, level)))
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+from typing import Dict, List, Optional
 
 import cv2
 import numpy as np
 
+from app.pipeline.frame import FrameContext
+
 
 @dataclass
 class QualityResult:
@@ -13,10 +16,20 @@ class QualityResult:
     acceptable: bool
 
 
-def assess_quality(image: np.ndarray) -> QualityResult:
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def assess_quality(image: np.ndarray, context: Optional[FrameContext] = None) -> QualityResult:
+    gray = context.gray if context is not None else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     blur_score = float(cv2.Laplacian(gray, cv2.CV_64F).var())
     _, bright = cv2.threshold(gray, 245, 255, cv2.THRESH_BINARY)
     glare_ratio = float(np.sum(bright > 0) / bright.size)
     acceptable = blur_score > 120.0 and glare_ratio < 0.18
     return QualityResult(blur_score=blur_score, glare_ratio=glare_ratio, acceptable=acceptable)
+
+
+def recapture_hints(quality: QualityResult, min_blur: float, max_glare: float) -> List[Dict[str, str]]:
+    """Reasons a frame is too poor to analyse, each with a hint the client can show; empty if usable."""
+    hints: List[Dict[str, str]] = []
+    if quality.blur_score < min_blur:
+        hints.append({"code": "blur", "hint": "Hold the camera steady and let it focus on the document"})
+    if quality.glare_ratio > max_glare:
+        hints.append({"code": "glare", "hint": "Tilt the document or move away from direct light to avoid glare"})
+    return hints
@@ -1,15 +1,32 @@
 from __future__ import annotations
 
+import heapq
 from dataclasses import dataclass
+from typing import Optional, Tuple
 
 import cv2
 import numpy as np
 
+from app.pipeline.frame import FrameContext
+
 
 @dataclass
 class RectifyResult:
     image: np.ndarray
     success: bool
+    source: Optional[np.ndarray] = None
+    matrix: Optional[np.ndarray] = None
+
+    def warp(self, width: int, height: int) -> np.ndarray:
+        """The rectified document at ``width`` x ``height``, interpolated once from the source frame.
+
+        ``matrix`` maps the source frame onto ``image``; it is rescaled to the requested size
+        so derived views never resample the already-resampled ``image``.
+        """
+        if self.source is None or self.matrix is None:
+            return cv2.resize(self.image, (width, height))
+        scale = np.diag([width / float(self.image.shape[1]), height / float(self.image.shape[0]), 1.0])
+        return cv2.warpPerspective(self.source, scale @ self.matrix, (width, height))
 
 
 def _order_points(pts: np.ndarray) -> np.ndarray:
@@ -23,52 +40,92 @@ def _order_points(pts: np.ndarray) -> np.ndarray:
     return rect
 
 
-def _four_point_transform(image: np.ndarray, pts: np.ndarray) -> np.ndarray:
+def _four_point_transform(pts: np.ndarray, output_width: int) -> Optional[Tuple[np.ndarray, Tuple[int, int]]]:
+    """Homography taking the quadrilateral ``pts`` straight to an ``output_width``-wide upright page."""
     rect = _order_points(pts)
     (tl, tr, br, bl) = rect
     width_a = np.linalg.norm(br - bl)
     width_b = np.linalg.norm(tr - tl)
-    max_width = int(max(width_a, width_b))
+    max_width = max(width_a, width_b)
     height_a = np.linalg.norm(tr - br)
     height_b = np.linalg.norm(tl - bl)
-    max_height = int(max(height_a, height_b))
+    max_height = max(height_a, height_b)
+    if int(max_width) == 0 or int(max_height) == 0:
+        return None
+    scale = output_width / float(int(max_width))
+    output_height = int(int(max_height) * scale)
     dst = np.array(
         [
             [0, 0],
-            [max_width - 1, 0],
-            [max_width - 1, max_height - 1],
-            [0, max_height - 1],
+            [output_width - 1, 0],
+            [output_width - 1, output_height - 1],
+            [0, output_height - 1],
         ],
         dtype="float32",
     )
-    matrix = cv2.getPerspectiveTransform(rect, dst)
-    warped = cv2.warpPerspective(image, matrix, (max_width, max_height))
-    return warped
+    return cv2.getPerspectiveTransform(rect, dst), (output_width, output_height)
 
 
-def rectify_document(image: np.ndarray, output_width: int = 1200) -> RectifyResult:
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def _detect_corners(gray: np.ndarray) -> Optional[np.ndarray]:
     blur = cv2.GaussianBlur(gray, (5, 5), 0)
     edges = cv2.Canny(blur, 75, 200)
 
     contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)
-
-    doc_contour = None
-    for contour in contours[:5]:
+    for contour in heapq.nlargest(5, contours, key=cv2.contourArea):
         peri = cv2.arcLength(contour, True)
         approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
         if len(approx) == 4:
-            doc_contour = approx
-            break
+            return approx.reshape(4, 2).astype(np.float32)
+    return None
+
+
+def _refine_corners(image: np.ndarray, corners: np.ndarray, radius: int) -> np.ndarray:
+    """Sub-pixel refine ``corners`` at full resolution, converting only a patch around each one."""
+    height, width = image.shape[:2]
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.05)
+    refined = corners.copy()
+    margin = radius * 2 + 2
+    for idx, (x, y) in enumerate(corners):
+        x0, y0 = max(0, int(x) - margin), max(0, int(y) - margin)
+        x1, y1 = min(width, int(x) + margin + 1), min(height, int(y) + margin + 1)
+        if x1 - x0 <= 2 * radius + 1 or y1 - y0 <= 2 * radius + 1:
+            continue
+        patch = cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+        point = np.array([[[x - x0, y - y0]]], dtype=np.float32)
+        cv2.cornerSubPix(patch, point, (radius, radius), (-1, -1), criteria)
+        refined[idx] = point[0, 0] + (x0, y0)
+    return refined
+
+
+def rectify_document(
+    image: np.ndarray,
+    output_width: int = 1200,
+    detect_max_side: int = 1000,
+    refine_corners: bool = False,
+    context: Optional[FrameContext] = None,
+) -> RectifyResult:
+    """Find the document quadrilateral and warp it flat to ``output_width`` pixels wide.
 
-    if doc_contour is None:
+    Boundary detection runs on a copy downscaled to at most ``detect_max_side`` pixels on
+    its longer side; corners are scaled back and, with ``refine_corners``, refined with
+    ``cornerSubPix`` on small full-resolution patches. Only the warp reads every
+    full-resolution pixel, and it maps straight to the output size; other working sizes
+    come from ``RectifyResult.warp``. A ``context`` for ``image`` shares its grayscale
+    views with the other stages.
+    """
+    context = context or FrameContext(image)
+    scale = min(1.0, detect_max_side / float(max(image.shape[:2])))
+    corners = _detect_corners(context.resized_gray(round(image.shape[1] * scale), round(image.shape[0] * scale)))
+    if corners is None:
         return RectifyResult(image=image, success=False)
+    corners = corners / scale
+    if refine_corners:
+        corners = _refine_corners(image, corners, radius=int(np.ceil(2.0 / scale)) + 2)
 
-    warped = _four_point_transform(image, doc_contour.reshape(4, 2))
-    if warped.shape[1] == 0 or warped.shape[0] == 0:
+    transform = _four_point_transform(corners, output_width)
+    if transform is None or transform[1][1] == 0:
         return RectifyResult(image=image, success=False)
 
-    scale = output_width / float(warped.shape[1])
-    resized = cv2.resize(warped, (output_width, int(warped.shape[0] * scale)))
-    return RectifyResult(image=resized, success=True)
+    matrix, size = transform
+    warped = cv2.warpPerspective(image, matrix, size)
+    return RectifyResult(image=warped, success=True, source=image, matrix=matrix)
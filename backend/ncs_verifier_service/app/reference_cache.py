@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Generic, Iterable, List, Optional, Tuple, TypeVar
+
+import cv2
+import numpy as np
+
+from app.config import settings
+from app.storage.features import feature_store, store_reference_features
+from app.pipeline.frame import FrameContext
+from app.pipeline.match import (
+    DESCRIPTOR_SIZE,
+    KeypointIndex,
+    MatchCandidate,
+    MatchLevelStats,
+    PreparedReference,
+    extract_keypoints,
+    global_descriptor,
+    match_reference,
+    match_size,
+    prepare_reference,
+    pyramid_level,
+    top_indices,
+)
+from app.pipeline.ssim import Moments, local_moments
+from app.storage.db import clear_result_cache, list_reference_descriptors, list_references
+
+logger = logging.getLogger("ncs_verifier")
+
+V = TypeVar("V", PreparedReference, Moments, np.ndarray)
+
+
+class ReferenceCache(Generic[V]):
+    """Process-wide LRU cache of per-reference arrays (anything with ``nbytes``), bounded by a byte budget."""
+
+    def __init__(self, max_bytes: int, loader: Optional[Callable[[Dict[str, Any]], Optional[V]]] = None) -> None:
+        self.max_bytes = max_bytes
+        self._loader = loader
+        self._items: "OrderedDict[str, V]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def get(self, ref_id: str) -> Optional[V]:
+        with self._lock:
+            prepared = self._items.get(ref_id)
+            if prepared is not None:
+                self._items.move_to_end(ref_id)
+            return prepared
+
+    def put(self, ref_id: str, prepared: V) -> None:
+        with self._lock:
+            self._discard(ref_id)
+            if prepared.nbytes > self.max_bytes:
+                return
+            self._items[ref_id] = prepared
+            self._nbytes += prepared.nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+    def discard(self, ref_id: str) -> None:
+        with self._lock:
+            self._discard(ref_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+    def _discard(self, ref_id: str) -> None:
+        prepared = self._items.pop(ref_id, None)
+        if prepared is not None:
+            self._nbytes -= prepared.nbytes
+
+    def load(self, row: Dict[str, Any]) -> Optional[V]:
+        """Return the cached value for a reference row, loading it on a miss."""
+        prepared = self.get(row["id"])
+        if prepared is not None or self._loader is None:
+            return prepared
+        prepared = self._loader(row)
+        if prepared is not None:
+            self.put(row["id"], prepared)
+        return prepared
+
+    def prepared_references(self, rows: Iterable[Dict[str, Any]]) -> List[Tuple[str, V]]:
+        references = []
+        for row in rows:
+            prepared = self.load(row)
+            if prepared is not None:
+                references.append((row["id"], prepared))
+        return references
+
+
+class DescriptorIndex:
+    """Every reference's global descriptor in one in-memory matrix, so shortlisting needs no I/O.
+
+    Built at warm-up and appended to by ``register_reference``. Descriptors of references
+    registered by another process are read from SQLite the first time they are needed.
+    """
+
+    def __init__(self) -> None:
+        self._positions: Dict[str, int] = {}
+        self._matrix = np.zeros((0, DESCRIPTOR_SIZE * DESCRIPTOR_SIZE), dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def add(self, ref_id: str, descriptor: np.ndarray) -> None:
+        with self._lock:
+            position = self._positions.get(ref_id)
+            if position is None:
+                position = len(self._positions)
+                if position == len(self._matrix):
+                    grown = np.zeros((max(64, 2 * position), self._matrix.shape[1]), dtype=np.float32)
+                    grown[:position] = self._matrix
+                    self._matrix = grown
+                self._positions[ref_id] = position
+            self._matrix[position] = descriptor
+
+    def clear(self) -> None:
+        with self._lock:
+            self._positions.clear()
+            self._matrix = self._matrix[:0]
+
+    def _fetch_missing(self, ref_ids: Iterable[str]) -> None:
+        with self._lock:
+            missing = [ref_id for ref_id in ref_ids if ref_id not in self._positions]
+        if missing:
+            for ref_id, descriptor in list_reference_descriptors(missing):
+                self.add(ref_id, np.frombuffer(descriptor, dtype=np.float32))
+
+    def get(self, ref_id: str) -> Optional[np.ndarray]:
+        self._fetch_missing([ref_id])
+        with self._lock:
+            position = self._positions.get(ref_id)
+            return self._matrix[position].copy() if position is not None else None
+
+    def shortlist(self, query_descriptor: np.ndarray, ref_ids: List[str], k: int) -> List[int]:
+        """Indices into ``ref_ids`` of the ``k`` references closest to the query, in their original order.
+
+        References with no stored descriptor cannot be ranked and are always kept.
+        """
+        self._fetch_missing(ref_ids)
+        with self._lock:
+            positions = np.array([self._positions.get(ref_id, -1) for ref_id in ref_ids], dtype=np.int64)
+            similarity = self._matrix[: len(self._positions)] @ query_descriptor
+        known = np.flatnonzero(positions >= 0)
+        keep = known[top_indices(similarity[positions[known]], k)]
+        return sorted(keep.tolist() + np.flatnonzero(positions < 0).tolist())
+
+
+descriptor_index = DescriptorIndex()
+
+
+def _load_prepared(row: Dict[str, Any]) -> Optional[PreparedReference]:
+    if row.get("feature_offset") is not None:
+        descriptor = descriptor_index.get(row["id"])
+        if descriptor is not None:
+            shape = (row["feature_height"], row["feature_width"])
+            gray = feature_store.view(row["feature_offset"], shape, row["feature_dtype"])
+            return PreparedReference(gray=gray, descriptor=descriptor)
+    image = cv2.imread(row["image_path"])
+    if image is None:
+        return None
+    prepared = prepare_reference(image)
+    descriptor_index.add(row["id"], prepared.descriptor)
+    return prepared
+
+
+reference_cache: ReferenceCache[PreparedReference] = ReferenceCache(settings.reference_cache_max_bytes, _load_prepared)
+# SSIM moment maps are 8x the size of a reference's grayscale array, so they are kept
+# apart, and only for references that reach full-width scoring or the tamper stage.
+moments_cache: ReferenceCache[Moments] = ReferenceCache(settings.reference_moments_cache_max_bytes)
+# Coarse pyramid levels of references scored with ``match_pyramid_levels`` above one, keyed "<ref_id>:<level>".
+pyramid_cache: ReferenceCache[np.ndarray] = ReferenceCache(settings.reference_pyramid_cache_max_bytes)
+keypoint_index = KeypointIndex(settings.keypoint_index_path)
+_match_executor: Optional[ThreadPoolExecutor] = None
+_match_executor_lock = threading.Lock()
+
+
+def _get_match_executor() -> Optional[ThreadPoolExecutor]:
+    global _match_executor
+    if settings.match_workers <= 1:
+        return None
+    with _match_executor_lock:
+        if _match_executor is None:
+            _match_executor = ThreadPoolExecutor(max_workers=settings.match_workers, thread_name_prefix="match")
+        return _match_executor
+
+
+def reference_moments(ref_id: str, prepared: PreparedReference) -> Moments:
+    """``local_moments`` of a prepared reference's grayscale array, from ``moments_cache``."""
+    moments = moments_cache.get(ref_id)
+    if moments is None:
+        moments = local_moments(prepared.gray)
+        moments_cache.put(ref_id, moments)
+    return moments
+
+
+def reference_pyramid(ref_id: str, prepared: PreparedReference, level: int) -> np.ndarray:
+    """``pyramid_level(prepared.gray, level)``, from ``pyramid_cache`` and built on the next finer cached level."""
+    key = f"{ref_id}:{level}"
+    gray = pyramid_cache.get(key)
+    if gray is None:
+        finer = reference_pyramid(ref_id, prepared, level - 1) if level > 1 else prepared.gray
+        gray = pyramid_level(finer, 1)
+        pyramid_cache.put(key, gray)
+    return gray
+
+
+def register_reference(ref_id: str, image: np.ndarray) -> None:
+    prepared = store_reference_features(ref_id, prepare_reference(image))
+    reference_cache.put(ref_id, prepared)
+    moments_cache.discard(ref_id)
+    for level in range(1, settings.match_pyramid_levels):
+        pyramid_cache.discard(f"{ref_id}:{level}")
+    descriptor_index.add(ref_id, prepared.descriptor)
+    if settings.match_engine == "orb":
+        keypoint_index.add(ref_id, extract_keypoints(prepared.gray))
+    clear_result_cache()
+
+
+def match_frame(
+    image: np.ndarray,
+    rows: List[Dict[str, Any]],
+    context: Optional[FrameContext] = None,
+) -> Optional[MatchCandidate]:
+    """Match a rectified frame against ``rows`` with the engine selected by ``settings.match_engine``.
+
+    The SSIM engine shortlists ``rows`` on ``descriptor_index`` first, so only the
+    shortlisted references are loaded into ``reference_cache``.
+    """
+    if not rows:
+        return None
+    if settings.match_engine == "orb":
+        return keypoint_index.match(image, [row["id"] for row in rows], context=context)
+    context = context or FrameContext(image)
+    levels: List[MatchLevelStats] = []
+    if 0 < settings.match_shortlist_k < len(rows):
+        query = context.resized_gray(*match_size(context.image))
+        ref_ids = [row["id"] for row in rows]
+        keep = descriptor_index.shortlist(global_descriptor(query), ref_ids, settings.match_shortlist_k)
+        levels.append(MatchLevelStats(DESCRIPTOR_SIZE, len(rows), len(rows) - len(keep)))
+        rows = [rows[idx] for idx in keep]
+    references = reference_cache.prepared_references(rows)
+    if not references:
+        return None
+    return match_reference(
+        image,
+        references,
+        pyramid_levels=settings.match_pyramid_levels,
+        prune_margin=settings.match_prune_margin,
+        executor=_get_match_executor(),
+        workers=settings.match_workers,
+        context=context,
+        reference_moments=reference_moments,
+        levels=levels,
+        reference_pyramid=reference_pyramid,
+    )
+
+
+def _backfill_features(rows: List[Dict[str, Any]]) -> int:
+    """Pack references that predate the feature store into it, once across all workers.
+
+    Runs under the feature store's exclusive lock and skips references another worker
+    stored meanwhile, so concurrent warm-ups do not append the same arrays twice.
+    """
+    stored = 0
+    with feature_store.exclusive():
+        done = {ref_id for ref_id, _ in list_reference_descriptors([row["id"] for row in rows])}
+        for row in rows:
+            if row["id"] in done:
+                continue
+            image = cv2.imread(row["image_path"])
+            if image is None:
+                continue
+            prepared = store_reference_features(row["id"], prepare_reference(image))
+            reference_cache.put(row["id"], prepared)
+            descriptor_index.add(row["id"], prepared.descriptor)
+            stored += 1
+    return stored
+
+
+def warm_reference_cache() -> None:
+    """Load reference features at startup.
+
+    References without packed features (loaded through ``cv2.imread`` otherwise) are
+    written to the feature store first. With the ORB engine, references that have no
+    keypoint shard yet (registered while another engine was selected, or before the
+    index existed) are backfilled into it.
+    """
+    rows = list_references()
+    missing = [row for row in rows if row.get("feature_offset") is None]
+    features_backfilled = _backfill_features(missing) if missing else 0
+    if features_backfilled:
+        rows = list_references()
+    for ref_id, descriptor in list_reference_descriptors():
+        descriptor_index.add(ref_id, np.frombuffer(descriptor, dtype=np.float32))
+    references = reference_cache.prepared_references(rows)
+    loaded = len(references)
+    backfilled = 0
+    if settings.match_engine == "orb":
+        keypoint_index.load()
+        for ref_id, prepared in references:
+            if ref_id not in keypoint_index:
+                keypoint_index.add(ref_id, extract_keypoints(prepared.gray))
+                backfilled += 1
+    logger.info(
+        "reference_cache_warmed %s",
+        json.dumps(
+            {
+                "references": loaded,
+                "cached": len(reference_cache),
+                "bytes": reference_cache.nbytes,
+                "descriptors": len(descriptor_index),
+                "keypoint_index": len(keypoint_index),
+                "features_backfilled": features_backfilled,
+                "keypoint_backfilled": backfilled,
+            }
+        ),
+    )
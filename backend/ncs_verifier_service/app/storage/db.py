@@ -3,8 +3,8 @@ from __future__ import annotations
 import json
 import os
 import sqlite3
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 from app.config import settings
 
@@ -30,6 +30,22 @@ def init_db() -> None:
             )
             """
         )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_reference_items_doc_type_version ON reference_items (doc_type, version)'
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS reference_features (
+                reference_id TEXT PRIMARY KEY,
+                offset INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                dtype TEXT NOT NULL,
+                descriptor BLOB NOT NULL,
+                created_at TEXT NOT NULL
+            )
+            """
+        )
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS audit_logs (
@@ -41,6 +57,16 @@ def init_db() -> None:
             )
             """
         )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS result_cache (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_created_at ON result_cache (created_at)")
         conn.commit()
 
 
@@ -63,9 +89,28 @@ def add_reference(
         conn.commit()
 
 
-def list_references() -> List[Dict[str, Any]]:
+def list_references(doc_type: Optional[str] = None, version: Optional[str] = None) -> List[Dict[str, Any]]:
+    clauses = []
+    params: List[str] = []
+    if doc_type is not None:
+        clauses.append("r.doc_type = ?")
+        params.append(doc_type)
+    if version is not None:
+        clauses.append("r.version = ?")
+        params.append(version)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
     with _connect() as conn:
-        rows = conn.execute("SELECT * FROM reference_items ORDER BY created_at DESC").fetchall()
+        rows = conn.execute(
+            f"""
+            SELECT r.*, f.offset AS feature_offset, f.height AS feature_height,
+                   f.width AS feature_width, f.dtype AS feature_dtype
+            FROM reference_items r
+            LEFT JOIN reference_features f ON f.reference_id = r.id
+            {where}
+            ORDER BY r.created_at DESC
+            """,
+            params,
+        ).fetchall()
         return [dict(row) for row in rows]
 
 
@@ -75,6 +120,44 @@ def get_reference(ref_id: str) -> Optional[Dict[str, Any]]:
         return dict(row) if row else None
 
 
+def list_reference_descriptors(ref_ids: Optional[Sequence[str]] = None) -> List[Tuple[str, bytes]]:
+    """``(reference_id, descriptor)`` pairs, for every reference or only ``ref_ids``."""
+    with _connect() as conn:
+        if ref_ids is None:
+            rows = conn.execute("SELECT reference_id, descriptor FROM reference_features").fetchall()
+            return [(row["reference_id"], row["descriptor"]) for row in rows]
+        pairs: List[Tuple[str, bytes]] = []
+        for start in range(0, len(ref_ids), 500):
+            chunk = list(ref_ids[start : start + 500])
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT reference_id, descriptor FROM reference_features WHERE reference_id IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            pairs.extend((row["reference_id"], row["descriptor"]) for row in rows)
+        return pairs
+
+
+def add_reference_features(
+    ref_id: str,
+    offset: int,
+    shape: Tuple[int, int],
+    dtype: str,
+    descriptor: bytes,
+) -> None:
+    created_at = datetime.utcnow().isoformat()
+    with _connect() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO reference_features
+                (reference_id, offset, height, width, dtype, descriptor, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (ref_id, offset, shape[0], shape[1], dtype, descriptor, created_at),
+        )
+        conn.commit()
+
+
 def add_audit_log(audit_id: str, doc_type: Optional[str], reference_id: Optional[str], result: Dict[str, Any]) -> None:
     created_at = datetime.utcnow().isoformat()
     with _connect() as conn:
@@ -86,3 +169,47 @@ def add_audit_log(audit_id: str, doc_type: Optional[str], reference_id: Optional
             (audit_id, doc_type, reference_id, json.dumps(result), created_at),
         )
         conn.commit()
+
+
+def reference_set_stamp() -> str:
+    """Cheap version stamp of the reference set; changes whenever a reference is added."""
+    with _connect() as conn:
+        row = conn.execute("SELECT COUNT(*) AS total, MAX(created_at) AS latest FROM reference_items").fetchone()
+        return f"{row['total']}:{row['latest']}"
+
+
+def get_cached_result(key: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
+    cutoff = (datetime.utcnow() - timedelta(seconds=ttl_seconds)).isoformat()
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT result FROM result_cache WHERE key = ? AND created_at >= ?",
+            (key, cutoff),
+        ).fetchone()
+        return json.loads(row["result"]) if row else None
+
+
+def put_cached_result(key: str, result: Dict[str, Any], ttl_seconds: int, max_entries: int) -> None:
+    """Store ``result`` under ``key``, dropping expired entries and the oldest beyond ``max_entries``."""
+    now = datetime.utcnow()
+    cutoff = (now - timedelta(seconds=ttl_seconds)).isoformat()
+    with _connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO result_cache (key, result, created_at) VALUES (?, ?, ?)",
+            (key, json.dumps(result), now.isoformat()),
+        )
+        conn.execute("DELETE FROM result_cache WHERE created_at < ?", (cutoff,))
+        conn.execute(
+            """
+            DELETE FROM result_cache WHERE key NOT IN (
+                SELECT key FROM result_cache ORDER BY created_at DESC LIMIT ?
+            )
+            """,
+            (max_entries,),
+        )
+        conn.commit()
+
+
+def clear_result_cache() -> None:
+    with _connect() as conn:
+        conn.execute("DELETE FROM result_cache")
+        conn.commit()
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+from app.pipeline.match import PreparedReference
+from app.storage.db import add_reference_features
+
+_ALIGNMENT = 64
+
+
+class FeatureStore:
+    """Append-only packed file of match-ready reference arrays, read through a shared memory map.
+
+    The file holds raw array bytes only; offsets, shapes and dtypes live in the
+    ``reference_features`` table so every worker can map the whole set without decoding.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._map: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+
+    def append(self, array: np.ndarray) -> int:
+        data = np.ascontiguousarray(array).tobytes()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "ab") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                end = handle.seek(0, os.SEEK_END)
+                padding = -end % _ALIGNMENT
+                handle.write(b"\0" * padding)
+                handle.write(data)
+                handle.flush()
+                os.fsync(handle.fileno())
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+        return end + padding
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """Hold a cross-process lock (separate from the one ``append`` takes) for check-then-append sequences."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def view(self, offset: int, shape: Tuple[int, ...], dtype: str = "uint8") -> np.ndarray:
+        """Return a read-only, zero-copy view of an array previously written by ``append``."""
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with self._lock:
+            if self._map is None or offset + size > self._map.size:
+                self._map = np.memmap(self.path, dtype=np.uint8, mode="r")
+            mapped = self._map
+        return mapped[offset : offset + size].view(dtype).reshape(shape)
+
+
+feature_store = FeatureStore(settings.feature_store_path)
+
+
+def store_reference_features(ref_id: str, prepared: PreparedReference) -> PreparedReference:
+    """Pack ``prepared`` into the feature store, index it and return it backed by the mapped view."""
+    gray = prepared.gray
+    offset = feature_store.append(gray)
+    add_reference_features(ref_id, offset, gray.shape, str(gray.dtype), prepared.descriptor.tobytes())
+    return PreparedReference(
+        gray=feature_store.view(offset, gray.shape, str(gray.dtype)),
+        descriptor=prepared.descriptor,
+    )
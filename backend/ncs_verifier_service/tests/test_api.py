@@ -1,4 +1,6 @@
 import io
+import json
+import zipfile
 
 import cv2
 import numpy as np
@@ -6,7 +8,11 @@ import pytest
 from fastapi.testclient import TestClient
 import pytesseract
 
+from app import api
+from app.config import settings
+from app.executor import BoundedExecutor
 from app.main import create_app
+from app.storage.db import init_db
 
 
 def _tesseract_available() -> bool:
@@ -33,3 +39,52 @@ def test_verify_endpoint() -> None:
         payload = response.json()
         assert "result" in payload
         assert "summary" in payload["result"]
+
+
+def test_verify_batch_streams_one_line_per_archive_member(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "data_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "batch.db"))
+    monkeypatch.setattr(settings, "result_cache_ttl_seconds", 0)
+    init_db()
+    client = TestClient(create_app())
+
+    _, blank = cv2.imencode(".png", np.full((120, 160, 3), 90, dtype=np.uint8))
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as bundle:
+        bundle.writestr("scans/blank.png", blank.tobytes())
+        bundle.writestr("scans/notes.txt", b"not an image")
+        bundle.writestr("__MACOSX/scans/._blank.png", b"")
+    files = [
+        ("files", ("scans.zip", archive.getvalue(), "application/zip")),
+        ("files", ("single.png", blank.tobytes(), "image/png")),
+    ]
+
+    response = client.post("/v1/verify/batch", files=files)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    items = {line["filename"]: line for line in lines[:-1]}
+    assert set(items) == {"scans.zip/scans/blank.png", "scans.zip/scans/notes.txt", "single.png"}
+    assert items["scans.zip/scans/notes.txt"]["status"] == 400
+    assert items["single.png"]["status"] == 422
+    assert lines[-1]["documents"] == 3 and lines[-1]["failed"] == 3
+
+
+def test_verify_batch_waits_for_pipeline_admission(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "data_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "batch.db"))
+    monkeypatch.setattr(settings, "result_cache_ttl_seconds", 0)
+    executor = BoundedExecutor(workers=1, max_queue=0)
+    monkeypatch.setattr(api, "pipeline_executor", executor)
+    init_db()
+    client = TestClient(create_app())
+
+    _, blank = cv2.imencode(".png", np.full((120, 160, 3), 90, dtype=np.uint8))
+    files = [("files", (f"page-{index}.png", blank.tobytes(), "image/png")) for index in range(4)]
+
+    response = client.post("/v1/verify/batch", files=files, data={"doc_type": "NCS_ORIGIN"})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+
+    assert response.status_code == 200
+    assert len(lines) == 5 and lines[-1]["documents"] == 4
+    assert executor.stats()["completed"] == 4
@@ -13,6 +13,7 @@ SERVER_DIR = os.path.join(BASE_DIR, "server")
 sys.path.append(SERVER_DIR)
 
 from app.config import settings  # noqa: E402
+from app.reference_cache import register_reference  # noqa: E402
 from app.storage import add_reference, init_db  # noqa: E402
 
 
@@ -41,6 +42,7 @@ def main() -> None:
 
     metadata = json.loads(args.metadata)
     add_reference(ref_id, args.doc_type, args.version, metadata, image_path)
+    register_reference(ref_id, image)
     print(f"Seeded reference {ref_id} -> {image_path}")
 
 
@@ -1,50 +1,51 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 import os
 import uuid
-from typing import List
+from dataclasses import asdict
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple, TypeVar
 
 import cv2
 import numpy as np
-import pytesseract
-from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi import APIRouter, File, Form, HTTPException, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 
+from app.analysis import AnalysisError, FrameLookup, lookup_frame
 from app.config import settings
+from app.events import session_events, set_session_status
+from app.executor import QueueFullError, pipeline_executor
+from app.jobs import JobQueueFullError, enqueue_frame_job, run_session_frame
 from app.models import (
-    AnalysisMetrics,
     AnalysisResult,
-    AnalysisSummary,
+    FrameJob,
     FrameResponse,
+    PipelineStats,
     ReferenceList,
     ReferenceRead,
     SessionCreate,
     SessionRead,
     SessionStatus,
 )
-from app.pipeline.match import match_reference
-from app.pipeline.ocr import run_ocr
-from app.pipeline.quality import assess_quality
-from app.pipeline.rectify import rectify_document
-from app.pipeline.score import compute_scores
-from app.pipeline.tamper import analyze_tamper
+from app.pipeline.stability import FrameCheck, FrameSelector
+from app.reference_cache import register_reference
 from app.storage import (
     add_reference,
     create_session,
     get_reference,
     get_session,
     list_references,
-    update_session_result,
-    update_session_status,
 )
 
 logger = logging.getLogger("ncs_verifier")
 router = APIRouter()
+T = TypeVar("T")
 
 
-def _load_image(file: UploadFile) -> np.ndarray:
-    data = file.file.read()
+def _decode_image(data: bytes) -> np.ndarray:
     if not data:
         raise HTTPException(status_code=400, detail="Empty image upload")
     image_array = np.frombuffer(data, dtype=np.uint8)
@@ -58,6 +59,19 @@ def _reference_dir(ref_id: str) -> str:
     return os.path.join(settings.data_dir, "references", ref_id)
 
 
+async def _run_pipeline(fn: Callable[..., T], *args: Any) -> T:
+    """Run CPU-bound work on the bounded pipeline executor; 429 with Retry-After when it is full."""
+    try:
+        return await pipeline_executor.run(fn, *args)
+    except QueueFullError as exc:
+        logger.warning("pipeline_queue_full %s", json.dumps(pipeline_executor.stats()))
+        raise HTTPException(
+            status_code=429,
+            detail="Verification queue is full; please retry",
+            headers={"Retry-After": str(exc.retry_after)},
+        ) from exc
+
+
 @router.post("/v1/references", response_model=ReferenceRead)
 async def create_reference(
     doc_type: str = Form(...),
@@ -71,29 +85,34 @@ async def create_reference(
     except json.JSONDecodeError as exc:
         raise HTTPException(status_code=400, detail="metadata must be valid JSON") from exc
 
+    data = await file.read()
+    created_at = await _run_pipeline(_store_reference, ref_id, doc_type, version, meta_dict, data)
+    return ReferenceRead(
+        id=ref_id,
+        doc_type=doc_type,
+        version=version,
+        metadata=meta_dict,
+        created_at=created_at,
+    )
+
+
+def _store_reference(ref_id: str, doc_type: str, version: str, meta_dict: dict, data: bytes) -> str:
+    image = _decode_image(data)
     ref_dir = _reference_dir(ref_id)
     os.makedirs(ref_dir, exist_ok=True)
     image_path = os.path.join(ref_dir, "original.jpg")
-
-    image = _load_image(file)
     cv2.imwrite(image_path, image)
 
     add_reference(ref_id, doc_type, version, meta_dict, image_path)
+    register_reference(ref_id, image)
     logger.info("reference_created %s", json.dumps({"reference_id": ref_id}))
-
-    return ReferenceRead(
-        id=ref_id,
-        doc_type=doc_type,
-        version=version,
-        metadata=meta_dict,
-        created_at=get_reference(ref_id)["created_at"],
-    )
+    return get_reference(ref_id)["created_at"]
 
 
 @router.get("/v1/references", response_model=ReferenceList)
-async def list_reference() -> ReferenceList:
+def list_reference(doc_type: str | None = None, version: str | None = None) -> ReferenceList:
     items = []
-    for row in list_references():
+    for row in list_references(doc_type, version):
         items.append(
             ReferenceRead(
                 id=row["id"],
@@ -107,7 +126,7 @@ async def list_reference() -> ReferenceList:
 
 
 @router.get("/v1/references/{ref_id}", response_model=ReferenceRead)
-async def get_reference_by_id(ref_id: str) -> ReferenceRead:
+def get_reference_by_id(ref_id: str) -> ReferenceRead:
     row = get_reference(ref_id)
     if not row:
         raise HTTPException(status_code=404, detail="Reference not found")
@@ -121,14 +140,14 @@ async def get_reference_by_id(ref_id: str) -> ReferenceRead:
 
 
 @router.post("/v1/sessions", response_model=SessionRead)
-async def create_session_endpoint(payload: SessionCreate) -> SessionRead:
+def create_session_endpoint(payload: SessionCreate) -> SessionRead:
     session_id = str(uuid.uuid4())
     create_session(session_id, payload.doc_type)
     return SessionRead(id=session_id, created_at=get_session(session_id)["created_at"], doc_type=payload.doc_type)
 
 
 @router.get("/v1/sessions/{session_id}/status", response_model=SessionStatus)
-async def get_session_status(session_id: str) -> SessionStatus:
+def get_session_status(session_id: str) -> SessionStatus:
     session = get_session(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -141,7 +160,7 @@ async def get_session_status(session_id: str) -> SessionStatus:
 
 
 @router.get("/v1/sessions/{session_id}/result", response_model=AnalysisResult)
-async def get_session_result(session_id: str) -> AnalysisResult:
+def get_session_result(session_id: str) -> AnalysisResult:
     session = get_session(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -151,97 +170,217 @@ async def get_session_result(session_id: str) -> AnalysisResult:
     return AnalysisResult.model_validate(result)
 
 
-@router.post("/v1/sessions/{session_id}/frame", response_model=FrameResponse)
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.get("/v1/sessions/{session_id}/events")
+async def stream_session_events(session_id: str, request: Request) -> StreamingResponse:
+    """Server-Sent Events: ``status`` on every stage transition, then ``result`` once the session is done."""
+    queue = session_events.subscribe(session_id)
+    session = await run_in_threadpool(get_session, session_id)
+    if not session:
+        session_events.unsubscribe(session_id, queue)
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    async def stream() -> AsyncIterator[str]:
+        try:
+            status = {
+                "session_id": session_id,
+                "stage": session["stage"],
+                "percent": session["percent"],
+                "message": session["message"],
+            }
+            yield _sse("status", status)
+            if session["result"]:
+                yield _sse("result", {"session_id": session_id, "result": json.loads(session["result"])})
+                return
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), settings.session_events_keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse(event["event"], event["data"])
+                if event["event"] == "result" or event["data"].get("stage") == "error":
+                    return
+        finally:
+            session_events.unsubscribe(session_id, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post(
+    "/v1/sessions/{session_id}/frame",
+    response_model=FrameResponse,
+    responses={202: {"model": FrameJob}},
+)
 async def submit_frame(
     session_id: str,
     file: UploadFile = File(...),
     doc_type: str | None = Form(None),
-) -> FrameResponse:
+    version: str | None = Form(None),
+) -> FrameResponse | JSONResponse:
+    data = await file.read()
+    if settings.frame_mode == "async":
+        job = await run_in_threadpool(_queue_frame, session_id, data, doc_type, version)
+        return JSONResponse(status_code=202, content=job.model_dump())
+    return await _submit_frame(session_id, data, doc_type, version)
+
+
+async def _submit_frame(session_id: str, data: bytes, doc_type: Optional[str], version: Optional[str]) -> FrameResponse:
+    """Decode and look the frame up before admission; only result-cache misses take a pipeline slot."""
+    doc_type, image, lookup = await run_in_threadpool(_lookup_frame, session_id, data, doc_type, version)
+    if lookup.cached is not None:
+        return await run_in_threadpool(_process_frame, session_id, image, doc_type, version, lookup)
+    return await _run_pipeline(_process_frame, session_id, image, doc_type, version, lookup)
+
+
+def _queue_frame(session_id: str, data: bytes, doc_type: Optional[str], version: Optional[str]) -> FrameJob:
+    session = get_session(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if not data:
+        raise HTTPException(status_code=400, detail="Empty image upload")
+    try:
+        job_id = enqueue_frame_job(session_id, data, doc_type or session["doc_type"], version)
+    except JobQueueFullError as exc:
+        raise HTTPException(
+            status_code=429,
+            detail="Verification queue is full; please retry",
+            headers={"Retry-After": str(settings.job_retry_after_seconds)},
+        ) from exc
+    return FrameJob(session_id=session_id, job_id=job_id, stage="queued")
+
+
+def _lookup_frame(
+    session_id: str, data: bytes, doc_type: Optional[str], version: Optional[str]
+) -> Tuple[Optional[str], np.ndarray, FrameLookup]:
     session = get_session(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
+    doc_type = doc_type or session["doc_type"]
 
-    update_session_status(session_id, "rectifying", 15)
-    image = _load_image(file)
-    quality = assess_quality(image)
+    set_session_status(session_id, "rectifying", 15)
+    image = _decode_image(data)
+    return doc_type, image, lookup_frame(image, doc_type, version)
 
-    rectified = rectify_document(image)
-    if not rectified.success:
-        update_session_status(session_id, "error", 100, "Could not detect document edges")
-        raise HTTPException(status_code=422, detail="Unable to detect document boundary; please hold steady")
 
-    update_session_status(session_id, "matching", 35)
-    references = []
-    for row in list_references():
-        ref_image = cv2.imread(row["image_path"])
-        if ref_image is not None:
-            references.append((row["id"], ref_image))
+def _process_frame(
+    session_id: str, image: np.ndarray, doc_type: Optional[str], version: Optional[str], lookup: FrameLookup
+) -> FrameResponse:
+    try:
+        analysis = run_session_frame(session_id, image, doc_type, version, lookup)
+    except AnalysisError as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail) from exc
 
-    match_candidate = match_reference(rectified.image, references) if references else None
-    match_score = match_candidate.score if match_candidate else 0.0
-    reference_id = match_candidate.reference_id if match_candidate else None
+    return FrameResponse(session_id=session_id, result=analysis.result)
 
-    update_session_status(session_id, "ocr", 55)
-    try:
-        ocr_result = run_ocr(rectified.image)
-    except pytesseract.pytesseract.TesseractNotFoundError as exc:
-        update_session_status(session_id, "error", 100, "Tesseract OCR not installed")
-        raise HTTPException(status_code=500, detail="Tesseract OCR not installed") from exc
-    ocr_quality_score = float(min(100.0, len(ocr_result.words) * 1.5))
-
-    update_session_status(session_id, "tamper", 75)
-    reference_image = None
-    reference_metadata: dict = {}
-    if reference_id:
-        row = get_reference(reference_id)
-        if row:
-            reference_image = cv2.imread(row["image_path"])
-            reference_metadata = json.loads(row["metadata"])
-
-    if reference_image is None:
-        reference_image = rectified.image
-    tamper = analyze_tamper(
-        rectified.image,
-        reference_image,
-        reference_metadata,
-        [word.bbox for word in ocr_result.words],
-    )
 
-    update_session_status(session_id, "scoring", 90)
-    scores = compute_scores(match_score, ocr_quality_score, tamper.tamper_score, quality)
-
-    summary = AnalysisSummary(
-        doc_type_guess=doc_type,
-        reference_id=reference_id,
-        match_score=scores.template_match_score,
-        tamper_risk_score=scores.tamper_risk_score,
-        confidence_band=scores.confidence_band,
-        disclaimer=(
-            "Offline verification against reference templates provides a risk assessment, "
-            "not proof of official issuance."
-        ),
-    )
+@router.get("/v1/pipeline/stats", response_model=PipelineStats)
+def get_pipeline_stats() -> PipelineStats:
+    return PipelineStats(**pipeline_executor.stats())
 
-    metrics = AnalysisMetrics(
-        template_match_score=scores.template_match_score,
-        ocr_quality_score=scores.ocr_quality_score,
-        tamper_risk_score=scores.tamper_risk_score,
-        quality_metrics={
-            "blur_score": quality.blur_score,
-            "glare_ratio": quality.glare_ratio,
-            "acceptable": quality.acceptable,
-        },
-    )
 
-    result = AnalysisResult(
-        summary=summary,
-        metrics=metrics,
-        extracted_fields=ocr_result.extracted_fields,
-        ocr_text=ocr_result.full_text,
-        findings=[finding.__dict__ for finding in tamper.findings],
+def _check_stream_frame(selector: FrameSelector, data: bytes) -> FrameCheck:
+    """Decode one preview frame and run the selector's cheap checks on it, off the event loop."""
+    return selector.add(_decode_image(data), data)
+
+
+@router.websocket("/v1/sessions/{session_id}/stream")
+async def stream_session_frames(
+    session_id: str,
+    websocket: WebSocket,
+    doc_type: str | None = None,
+    version: str | None = None,
+) -> None:
+    """Accept a stream of preview frames and run the full pipeline once, on the best of them.
+
+    Each binary message is one encoded frame. It is answered with a ``frame`` message
+    carrying its quality, re-capture hints and corner stability. Once ``FrameSelector``
+    is ready (or after ``stream_max_frames`` frames), the best frame is analysed: the
+    session's ``status`` updates are forwarded and a final ``result`` or ``error``
+    message is sent before the socket closes.
+    """
+    await websocket.accept()
+    if not await run_in_threadpool(get_session, session_id):
+        await websocket.send_json({"type": "error", "status": 404, "detail": "Session not found"})
+        await websocket.close()
+        return
+
+    selector = FrameSelector(
+        settings.quality_min_blur,
+        settings.quality_max_glare,
+        stable_frames=settings.stream_stable_frames,
+        corner_tolerance=settings.stream_corner_tolerance,
+        detect_max_side=settings.stream_detect_max_side,
     )
+    try:
+        while selector.frames < settings.stream_max_frames:
+            data = await websocket.receive_bytes()
+            try:
+                check = await run_in_threadpool(_check_stream_frame, selector, data)
+            except HTTPException as exc:
+                await websocket.send_json({"type": "error", "status": exc.status_code, "detail": exc.detail})
+                continue
+            await websocket.send_json(
+                {
+                    "type": "frame",
+                    "index": check.index,
+                    "quality": asdict(check.quality),
+                    "hints": check.hints,
+                    "corners_found": check.corners_found,
+                    "stable_frames": check.stable_frames,
+                }
+            )
+            if check.ready:
+                break
+
+        candidate = selector.best()
+        if candidate is None:
+            await websocket.send_json(
+                {"type": "error", "status": 422, "detail": "No frame showed the whole document; please re-capture"}
+            )
+            await websocket.close()
+            return
+        await websocket.send_json({"type": "selected", "index": candidate.index, "frames": selector.frames})
+        logger.info(
+            "stream_frame_selected %s",
+            json.dumps({"session_id": session_id, "index": candidate.index, "frames": selector.frames}),
+        )
+        await _stream_pipeline(websocket, session_id, candidate.payload, doc_type, version)
+        await websocket.close()
+    except WebSocketDisconnect:
+        logger.info("stream_disconnected %s", json.dumps({"session_id": session_id, "frames": selector.frames}))
 
-    update_session_result(session_id, result.model_dump())
-    logger.info("session_completed %s", json.dumps({"session_id": session_id}))
 
-    return FrameResponse(session_id=session_id, result=result)
+async def _stream_pipeline(
+    websocket: WebSocket,
+    session_id: str,
+    data: bytes,
+    doc_type: Optional[str],
+    version: Optional[str],
+) -> None:
+    """Run ``_submit_frame``, forwarding session status events until it finishes."""
+    queue = session_events.subscribe(session_id)
+    try:
+        task = asyncio.ensure_future(_submit_frame(session_id, data, doc_type, version))
+        while not task.done():
+            event = asyncio.ensure_future(queue.get())
+            await asyncio.wait({task, event}, return_when=asyncio.FIRST_COMPLETED)
+            if not event.done():
+                event.cancel()
+            elif event.result()["event"] == "status":
+                await websocket.send_json({"type": "status", **event.result()["data"]})
+        try:
+            response = task.result()
+        except HTTPException as exc:
+            await websocket.send_json({"type": "error", "status": exc.status_code, "detail": exc.detail})
+            return
+        await websocket.send_json({"type": "result", **response.model_dump(mode="json")})
+    finally:
+        session_events.unsubscribe(session_id, queue)
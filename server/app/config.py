@@ -8,9 +8,47 @@ class Settings(BaseSettings):
     allowed_origins: str = "*"
     data_dir: str = "server/data"
     database_path: str = "server/data/ncs_verifier.db"
+    feature_store_path: str = "server/data/reference_features.bin"
+    keypoint_index_path: str = "server/data/reference_keypoints"
     tesseract_cmd: str | None = None
     server_host: str = "0.0.0.0"
     server_port: int = 8000
+    reference_cache_max_bytes: int = 512 * 1024 * 1024
+    reference_moments_cache_max_bytes: int = 256 * 1024 * 1024
+    reference_pyramid_cache_max_bytes: int = 64 * 1024 * 1024
+    match_shortlist_k: int = 20
+    match_engine: str = "ssim"
+    match_pyramid_levels: int = 1
+    match_prune_margin: float = 10.0
+    match_workers: int = 1
+    tamper_mode: str = "grid"
+    tamper_min_cell: int = 24
+    tamper_time_budget_ms: float = 50.0
+    pipeline_workers: int = 4
+    pipeline_concurrency: int = 2
+    pipeline_queue_size: int = 8
+    ocr_engine: str = "auto"
+    ocr_pool_size: int = 2
+    ocr_field_zones: bool = True
+    ocr_tiles: int = 1
+    ocr_tile_overlap: int = 64
+    result_cache_ttl_seconds: int = 3600
+    result_cache_max_entries: int = 1000
+    quality_gate: str = "off"
+    quality_min_blur: float = 30.0
+    quality_max_glare: float = 0.6
+    rectify_max_side: int = 1000
+    rectify_refine_corners: bool = True
+    frame_mode: str = "sync"
+    job_workers: int = 2
+    job_max_queued: int = 100
+    job_retry_after_seconds: int = 5
+    job_lease_seconds: float = 30.0
+    session_events_keepalive_seconds: float = 15.0
+    stream_stable_frames: int = 3
+    stream_corner_tolerance: float = 0.02
+    stream_detect_max_side: int = 480
+    stream_max_frames: int = 90
 
     model_config = SettingsConfigDict(env_file=".env", env_prefix="NCS_")
 
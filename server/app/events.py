@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.storage import update_session_result, update_session_status
+
+Event = Dict[str, Any]
+
+
+class SessionEvents:
+    """In-process pub/sub of session progress, bridging pipeline threads to asyncio subscribers.
+
+    ``publish`` may be called from any thread; each subscriber gets the event on its own
+    event loop's queue. Nothing is persisted here: a subscriber sees only events published
+    after it subscribed, so it should read the current session state once afterwards.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+
+    def subscribe(self, session_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers.setdefault(session_id, []).append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, session_id: str, queue: asyncio.Queue) -> None:
+        with self._lock:
+            remaining = [entry for entry in self._subscribers.get(session_id, []) if entry[1] is not queue]
+            if remaining:
+                self._subscribers[session_id] = remaining
+            else:
+                self._subscribers.pop(session_id, None)
+
+    def publish(self, session_id: str, event: Event) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers.get(session_id, []))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                self.unsubscribe(session_id, queue)
+
+
+session_events = SessionEvents()
+
+
+def set_session_status(session_id: str, stage: str, percent: int, message: Optional[str] = None) -> None:
+    """Persist a session's progress and push it to live subscribers."""
+    update_session_status(session_id, stage, percent, message)
+    session_events.publish(
+        session_id,
+        {"event": "status", "data": {"session_id": session_id, "stage": stage, "percent": percent, "message": message}},
+    )
+
+
+def set_session_result(session_id: str, result: Dict[str, Any]) -> None:
+    """Persist a session's final result and push the ``done`` status and the result to live subscribers."""
+    update_session_result(session_id, result)
+    session_events.publish(
+        session_id,
+        {"event": "status", "data": {"session_id": session_id, "stage": "done", "percent": 100, "message": None}},
+    )
+    session_events.publish(session_id, {"event": "result", "data": {"session_id": session_id, "result": result}})
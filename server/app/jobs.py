@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import uuid
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional, Set
+
+import cv2
+import numpy as np
+
+from app.analysis import AnalysisError, FrameAnalysis, FrameLookup, analyze_frame
+from app.config import settings
+from app.events import set_session_result, set_session_status
+from app.storage import add_job, claim_job, count_jobs, finish_job, heartbeat_jobs, requeue_stale_jobs
+
+logger = logging.getLogger("ncs_verifier")
+
+_POLL_SECONDS = 1.0
+
+
+class JobQueueFullError(Exception):
+    """Raised when ``job_max_queued`` frames are already waiting."""
+
+
+def run_session_frame(
+    session_id: str,
+    image: np.ndarray,
+    doc_type: Optional[str],
+    version: Optional[str],
+    lookup: Optional[FrameLookup] = None,
+) -> FrameAnalysis:
+    """Analyze ``image`` for a session, writing progress and the result (or error) into the session."""
+
+    def progress(status: str, percent: int) -> None:
+        set_session_status(session_id, status, percent)
+
+    try:
+        analysis = analyze_frame(image, doc_type, version, progress, lookup=lookup)
+    except AnalysisError as exc:
+        set_session_status(session_id, "error", 100, exc.message)
+        raise
+
+    set_session_result(session_id, analysis.result.model_dump())
+    match_candidate = analysis.match
+    match_levels = [asdict(level) for level in match_candidate.levels] if match_candidate else []
+    logger.info(
+        "session_completed %s",
+        json.dumps(
+            {
+                "session_id": session_id,
+                "cached": analysis.cached,
+                "match_levels": match_levels,
+                "stage_ms": analysis.timings_ms,
+            }
+        ),
+    )
+    return analysis
+
+
+def enqueue_frame_job(session_id: str, data: bytes, doc_type: Optional[str], version: Optional[str]) -> str:
+    """Store an uploaded frame and queue it for the background workers; returns the job id."""
+    if count_jobs("queued") >= settings.job_max_queued:
+        raise JobQueueFullError()
+    job_id = str(uuid.uuid4())
+    job_dir = os.path.join(settings.data_dir, "jobs")
+    os.makedirs(job_dir, exist_ok=True)
+    upload_path = os.path.join(job_dir, f"{job_id}.upload")
+    with open(upload_path, "wb") as handle:
+        handle.write(data)
+
+    add_job(job_id, session_id, doc_type, version, upload_path)
+    set_session_status(session_id, "queued", 0)
+    job_workers.notify()
+    logger.info("job_queued %s", json.dumps({"job_id": job_id, "session_id": session_id}))
+    return job_id
+
+
+class JobWorkers:
+    """Background threads that drain the ``jobs`` table, independent of the HTTP workers.
+
+    Workers wake when a job is queued in this process and otherwise poll every
+    ``_POLL_SECONDS``, so jobs queued by another process are picked up too. Running jobs
+    hold a lease of ``job_lease_seconds`` that a heartbeat thread renews; a job whose
+    lease lapsed belonged to a process that died and is re-queued, on ``start`` and on
+    every heartbeat, while jobs of live processes are left alone.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.workers = max(1, workers)
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._running: Set[str] = set()
+        self._running_lock = threading.Lock()
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        requeued = requeue_stale_jobs(settings.job_lease_seconds)
+        self._stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"job-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        logger.info("job_workers_started %s", json.dumps({"workers": self.workers, "requeued": requeued}))
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def _loop(self) -> None:
+        while not self._stopping.is_set():
+            self._wake.clear()
+            if not self.run_next():
+                self._wake.wait(_POLL_SECONDS)
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stopping.wait(settings.job_lease_seconds / 3.0):
+            with self._running_lock:
+                running = list(self._running)
+            heartbeat_jobs(running)
+            requeued = requeue_stale_jobs(settings.job_lease_seconds)
+            if requeued:
+                logger.info("jobs_requeued %s", json.dumps({"requeued": requeued}))
+                self._wake.set()
+
+    def run_next(self) -> bool:
+        """Claim and process one queued job; returns ``False`` when the queue is empty."""
+        job = claim_job()
+        if job is None:
+            return False
+        with self._running_lock:
+            self._running.add(job["id"])
+        try:
+            self._process(job)
+        finally:
+            with self._running_lock:
+                self._running.discard(job["id"])
+        return True
+
+    def _process(self, job: Dict[str, Any]) -> None:
+        session_id = job["session_id"]
+        try:
+            set_session_status(session_id, "rectifying", 15)
+            image = cv2.imread(job["upload_path"], cv2.IMREAD_COLOR)
+            if image is None:
+                set_session_status(session_id, "error", 100, "Unsupported image format")
+                finish_job(job["id"], "error", "Unsupported image format")
+                return
+            run_session_frame(session_id, image, job["doc_type"], job["version"])
+        except AnalysisError as exc:
+            finish_job(job["id"], "error", exc.message)
+        except Exception as exc:
+            logger.exception("job_failed %s", json.dumps({"job_id": job["id"], "session_id": session_id}))
+            set_session_status(session_id, "error", 100, "Verification failed")
+            finish_job(job["id"], "error", str(exc))
+        else:
+            finish_job(job["id"], "done")
+        finally:
+            if os.path.exists(job["upload_path"]):
+                os.remove(job["upload_path"])
+
+
+job_workers = JobWorkers(settings.job_workers)
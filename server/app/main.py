@@ -8,8 +8,11 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import pytesseract
 
+from app.analysis import get_ocr_engine
 from app.api import router
 from app.config import settings
+from app.jobs import job_workers
+from app.reference_cache import warm_reference_cache
 from app.storage import init_db
 
 
@@ -47,8 +50,16 @@ def create_app() -> FastAPI:
     @app.on_event("startup")
     def _startup() -> None:
         init_db()
+        warm_reference_cache()
+        get_ocr_engine()
+        if settings.frame_mode == "async":
+            job_workers.start()
         logging.getLogger("ncs_verifier").info("startup %s", json.dumps({"status": "ready"}))
 
+    @app.on_event("shutdown")
+    def _shutdown() -> None:
+        job_workers.stop()
+
     return app
 
 
@@ -41,6 +41,12 @@ class SessionStatus(BaseModel):
     message: Optional[str] = None
 
 
+class FrameJob(BaseModel):
+    session_id: str
+    job_id: str
+    stage: str
+
+
 class QualityMetrics(BaseModel):
     blur_score: float
     glare_ratio: float
@@ -96,6 +102,18 @@ class AnalysisResult(BaseModel):
     findings: List[Finding]
 
 
+class PipelineStats(BaseModel):
+    workers: int
+    max_queue: int
+    running: int
+    queued: int
+    completed: int
+    rejected: int
+    wait_ms_avg: float
+    wait_ms_max: float
+    run_ms_avg: float
+
+
 class FrameResponse(BaseModel):
     session_id: str
     result: AnalysisResult
@@ -1,43 +1,431 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Iterable, Optional, Tuple
+import hashlib
+import os
+import threading
+from collections import Counter
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
-from skimage.metrics import structural_similarity as ssim
+
+from app.pipeline.frame import FrameContext
+from app.pipeline.ssim import Moments, batch_ssim
+
+MATCH_WIDTH = 800
+DESCRIPTOR_SIZE = 16
+
+_ORB_FEATURES = 1000
+_LSH_INDEX_PARAMS = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
+_LSH_SEARCH_PARAMS = dict(checks=50)
+_RATIO_TEST = 0.75
+_VERIFY_CANDIDATES = 5
+# Index neighbours per query descriptor, so each reference among them gets its own ratio test.
+_KNN_NEIGHBOURS = 8
+# Allowed sets up to this size are matched exactly, reference by reference, instead of via the index.
+_EXACT_MATCH_REFERENCES = 32
+_MIN_GOOD_MATCHES = 30
+
+
+@dataclass
+class MatchLevelStats:
+    """How many candidates one matching stage scored and how many it dropped."""
+
+    width: int
+    scored: int
+    pruned: int
 
 
 @dataclass
 class MatchCandidate:
     reference_id: str
     score: float
+    levels: List[MatchLevelStats] = field(default_factory=list)
+
+
+@dataclass
+class PreparedReference:
+    """Canonical form of a reference shared by the match and tamper stages.
+
+    ``gray`` is the reference at MATCH_WIDTH in grayscale and ``descriptor`` its global
+    shortlist descriptor. ``moments`` may carry the SSIM mean/mean-of-squares maps of
+    ``gray`` so request-time SSIM only computes query-side and cross terms; at 8x the size
+    of ``gray`` they are attached only to references that are actually scored.
+    """
+
+    gray: np.ndarray
+    descriptor: np.ndarray
+    moments: Optional[Moments] = None
+
+    @property
+    def nbytes(self) -> int:
+        moments = self.moments.nbytes if self.moments is not None else 0
+        return self.gray.nbytes + self.descriptor.nbytes + moments
+
+
+def _resize_for_match(image: np.ndarray) -> np.ndarray:
+    return cv2.resize(image, match_size(image))
+
 
+def match_size(image: np.ndarray) -> Tuple[int, int]:
+    """(width, height) of ``image`` once resized to MATCH_WIDTH."""
+    scale = MATCH_WIDTH / float(image.shape[1])
+    return MATCH_WIDTH, int(image.shape[0] * scale)
 
-def _resize_for_match(image: np.ndarray, width: int = 800) -> np.ndarray:
-    scale = width / float(image.shape[1])
-    return cv2.resize(image, (width, int(image.shape[0] * scale)))
+
+def _match_gray(image: np.ndarray) -> np.ndarray:
+    # A grayscale frame already at MATCH_WIDTH (e.g. warped there directly) is used as is.
+    if image.ndim == 2 and image.shape[1] == MATCH_WIDTH:
+        return image
+    return cv2.cvtColor(_resize_for_match(image), cv2.COLOR_BGR2GRAY)
+
+
+def global_descriptor(gray: np.ndarray) -> np.ndarray:
+    """Zero-mean, unit-norm DESCRIPTOR_SIZE x DESCRIPTOR_SIZE thumbnail used for shortlisting."""
+    thumb = cv2.resize(gray, (DESCRIPTOR_SIZE, DESCRIPTOR_SIZE), interpolation=cv2.INTER_AREA)
+    vector = thumb.astype(np.float32).ravel()
+    vector -= vector.mean()
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+def prepare_reference(image: np.ndarray) -> PreparedReference:
+    gray = _match_gray(image)
+    return PreparedReference(gray=gray, descriptor=global_descriptor(gray))
+
+
+def pyramid_level(gray: np.ndarray, level: int) -> np.ndarray:
+    """``gray`` after ``level`` rounds of ``cv2.pyrDown``."""
+    for _ in range(level):
+        gray = cv2.pyrDown(gray)
+    return gray
+
+
+def _score_candidates(
+    query: np.ndarray,
+    grays: Sequence[np.ndarray],
+    executor: Optional[Executor],
+    workers: int,
+    moments: Optional[Sequence[Optional[Moments]]] = None,
+    query_moments: Optional[Moments] = None,
+) -> np.ndarray:
+    """SSIM of ``query`` against ``grays``, split into ``workers`` chunks when an executor is given.
+
+    Chunk results are concatenated in submission order, so the returned scores (and the
+    first-maximum tie-break applied to them) never depend on which chunk finishes first.
+    """
+    if moments is None:
+        moments = [None] * len(grays)
+    if executor is None or workers <= 1 or len(grays) <= 1:
+        return batch_ssim(query, grays, moments, query_moments)
+    chunk_size = -(-len(grays) // workers)
+    futures = [
+        executor.submit(
+            batch_ssim,
+            query,
+            list(grays[start : start + chunk_size]),
+            list(moments[start : start + chunk_size]),
+            query_moments,
+        )
+        for start in range(0, len(grays), chunk_size)
+    ]
+    return np.concatenate([future.result() for future in futures])
 
 
 def compute_match_score(image: np.ndarray, reference_image: np.ndarray) -> float:
-    image_resized = _resize_for_match(image)
-    reference_resized = _resize_for_match(reference_image)
-    min_height = min(image_resized.shape[0], reference_resized.shape[0])
-    image_resized = image_resized[:min_height, :]
-    reference_resized = reference_resized[:min_height, :]
-    gray_a = cv2.cvtColor(image_resized, cv2.COLOR_BGR2GRAY)
-    gray_b = cv2.cvtColor(reference_resized, cv2.COLOR_BGR2GRAY)
-    score = ssim(gray_a, gray_b)
-    return float(score * 100.0)
+    scores = batch_ssim(_match_gray(image), [_match_gray(reference_image)])
+    return float(scores[0] * 100.0)
+
+
+def top_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the ``k`` highest ``scores``, in their original order."""
+    if k <= 0 or k >= len(scores):
+        return np.arange(len(scores))
+    return np.sort(np.argpartition(-scores, k - 1)[:k])
+
+
+def shortlist_indices(query_descriptor: np.ndarray, descriptors: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the ``k`` descriptors most correlated with the query, in their original order."""
+    if k <= 0 or k >= len(descriptors):
+        return np.arange(len(descriptors))
+    return top_indices(descriptors @ query_descriptor, k)
 
 
 def match_reference(
     image: np.ndarray,
-    references: Iterable[Tuple[str, np.ndarray]],
+    references: Iterable[Tuple[str, PreparedReference]],
+    shortlist_k: int = 0,
+    pyramid_levels: int = 1,
+    prune_margin: float = 10.0,
+    executor: Optional[Executor] = None,
+    workers: int = 1,
+    context: Optional[FrameContext] = None,
+    reference_moments: Optional[Callable[[str, PreparedReference], Optional[Moments]]] = None,
+    levels: Optional[List[MatchLevelStats]] = None,
+    reference_pyramid: Optional[Callable[[str, PreparedReference, int], np.ndarray]] = None,
 ) -> Optional[MatchCandidate]:
-    best: Optional[MatchCandidate] = None
-    for ref_id, ref_image in references:
-        score = compute_match_score(image, ref_image)
-        if best is None or score > best.score:
-            best = MatchCandidate(reference_id=ref_id, score=score)
-    return best
+    """Find the best reference for ``image``.
+
+    When ``shortlist_k`` is positive, only the ``shortlist_k`` references whose global
+    descriptors are closest to the frame's are scored with SSIM. With ``pyramid_levels``
+    above one, candidates are first scored on ``cv2.pyrDown`` levels from coarsest to
+    finest, and any candidate more than ``prune_margin`` score points behind that level's
+    leader is dropped before the next level. The returned score always comes from the
+    full MATCH_WIDTH level, and ``levels`` records what each stage scored and pruned.
+
+    With an ``executor``, each stage's candidates are scored in ``workers`` parallel
+    chunks. Ties go to the candidate that comes first in ``references``, as in the
+    sequential path.
+
+    A ``context`` for ``image`` supplies the match-width view, its pyramid levels and
+    their moment maps, computed once per frame rather than once per scoring chunk.
+    ``reference_moments(ref_id, prepared)`` may supply the moment maps of the references
+    that reach the full-width level (by default ``prepared.moments``), and
+    ``reference_pyramid(ref_id, prepared, level)`` their coarser levels (by default
+    ``pyramid_level``, recomputed on every call). ``levels`` holds the stats of any stage
+    that already narrowed ``references`` before this call.
+    """
+    context = context or FrameContext(_match_gray(image))
+    size = match_size(context.image)
+    query = context.resized_gray(*size)
+    candidates = list(references)
+    levels = list(levels or [])
+    if shortlist_k > 0 and len(candidates) > shortlist_k:
+        descriptors = np.stack([prepared.descriptor for _, prepared in candidates])
+        keep = shortlist_indices(global_descriptor(query), descriptors, shortlist_k)
+        levels.append(MatchLevelStats(DESCRIPTOR_SIZE, len(candidates), len(candidates) - len(keep)))
+        candidates = [candidates[idx] for idx in keep]
+
+    if not candidates:
+        return None
+    for level in range(pyramid_levels - 1, 0, -1):
+        if len(candidates) == 1:
+            break
+        query_level = context.pyramid(*size, level)
+        grays = [
+            reference_pyramid(ref_id, prepared, level) if reference_pyramid is not None
+            else pyramid_level(prepared.gray, level)
+            for ref_id, prepared in candidates
+        ]
+        query_moments = context.moments(*size, level)
+        scores = _score_candidates(query_level, grays, executor, workers, query_moments=query_moments)
+        survivors = scores * 100.0 >= scores.max() * 100.0 - prune_margin
+        levels.append(MatchLevelStats(query_level.shape[1], len(candidates), int((~survivors).sum())))
+        candidates = [candidate for candidate, keep in zip(candidates, survivors) if keep]
+
+    scores = _score_candidates(
+        query,
+        [prepared.gray for _, prepared in candidates],
+        executor,
+        workers,
+        [
+            reference_moments(ref_id, prepared) if reference_moments is not None else prepared.moments
+            for ref_id, prepared in candidates
+        ],
+        context.moments(*size),
+    )
+    levels.append(MatchLevelStats(query.shape[1], len(candidates), 0))
+    best = int(np.argmax(scores))
+    return MatchCandidate(reference_id=candidates[best][0], score=float(scores[best] * 100.0), levels=levels)
+
+
+@dataclass
+class KeypointFeatures:
+    """ORB keypoint coordinates (N, 2) and binary descriptors (N, 32) of a match-width image."""
+
+    points: np.ndarray
+    descriptors: np.ndarray
+
+
+def extract_keypoints(gray: np.ndarray) -> KeypointFeatures:
+    orb = cv2.ORB_create(nfeatures=_ORB_FEATURES)
+    keypoints, descriptors = orb.detectAndCompute(gray, None)
+    if descriptors is None:
+        return KeypointFeatures(
+            points=np.zeros((0, 2), dtype=np.float32),
+            descriptors=np.zeros((0, 32), dtype=np.uint8),
+        )
+    points = np.array([kp.pt for kp in keypoints], dtype=np.float32)
+    return KeypointFeatures(points=points, descriptors=descriptors)
+
+
+def _exact_ratio_pairs(
+    query: KeypointFeatures, features: List[KeypointFeatures], indices: List[int]
+) -> Dict[int, List[Tuple[int, int]]]:
+    """Ratio-test survivors of brute-force kNN against each of ``indices`` on its own."""
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    pairs: Dict[int, List[Tuple[int, int]]] = {}
+    for idx in indices:
+        if len(features[idx].descriptors) < 2:
+            continue
+        for neighbours in matcher.knnMatch(query.descriptors, features[idx].descriptors, k=2):
+            if len(neighbours) == 2 and neighbours[0].distance < _RATIO_TEST * neighbours[1].distance:
+                pairs.setdefault(idx, []).append((neighbours[0].queryIdx, neighbours[0].trainIdx))
+    return pairs
+
+
+def _indexed_ratio_pairs(
+    knn: Sequence[Sequence[cv2.DMatch]], slots: List[int], allowed: Optional[List[bool]]
+) -> Dict[int, List[Tuple[int, int]]]:
+    """Per-reference ratio-test survivors of an index query, skipping references not ``allowed``.
+
+    ``allowed`` is indexed like the matcher's images. A reference's nearest neighbour is
+    compared with its own second nearest; when that fell outside the query's neighbours,
+    the farthest neighbour returned is a lower bound for it.
+    """
+    pairs: Dict[int, List[Tuple[int, int]]] = {}
+    for neighbours in knn:
+        if not neighbours:
+            continue
+        horizon = neighbours[-1].distance
+        grouped: Dict[int, List[cv2.DMatch]] = {}
+        for neighbour in neighbours:
+            if allowed is None or allowed[neighbour.imgIdx]:
+                grouped.setdefault(neighbour.imgIdx, []).append(neighbour)
+        for img_idx, group in grouped.items():
+            second = group[1].distance if len(group) > 1 else horizon
+            if group[0].distance < _RATIO_TEST * second:
+                pairs.setdefault(slots[img_idx], []).append((group[0].queryIdx, group[0].trainIdx))
+    return pairs
+
+
+def _verify_geometry(query: KeypointFeatures, reference: KeypointFeatures, pairs: List[Tuple[int, int]]) -> int:
+    if len(pairs) < 4:
+        return 0
+    src = query.points[[q for q, _ in pairs]].reshape(-1, 1, 2)
+    dst = reference.points[[r for _, r in pairs]].reshape(-1, 1, 2)
+    _, mask = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
+    return int(mask.sum()) if mask is not None else 0
+
+
+class KeypointIndex:
+    """Approximate nearest-neighbour (FLANN LSH) index over the ORB descriptors of all references.
+
+    Each reference's keypoints and descriptors are persisted as their own ``.npz`` shard in
+    the ``path`` directory, so adding a reference writes one small file however large the
+    catalogue is, and concurrent workers never rewrite each other's entries. OpenCV's
+    Python bindings cannot serialise a trained LSH index, so ``load`` retrains it from the
+    shards, which takes well under a second for thousands of references.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._ids: List[str] = []
+        self._features: List[KeypointFeatures] = []
+        self._positions: Dict[str, int] = {}
+        self._shards: Dict[str, float] = {}
+        self._matcher: Optional[cv2.FlannBasedMatcher] = None
+        self._slots: List[int] = []
+        self._loaded_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, ref_id: object) -> bool:
+        return ref_id in self._positions
+
+    def add(self, ref_id: str, features: KeypointFeatures) -> None:
+        """Add or replace a reference and write its shard."""
+        os.makedirs(self.path, exist_ok=True)
+        name = f"{hashlib.sha1(ref_id.encode()).hexdigest()}.npz"
+        tmp_path = os.path.join(self.path, f".{name}.tmp")
+        with open(tmp_path, "wb") as handle:
+            np.savez(handle, id=np.array(ref_id), points=features.points, descriptors=features.descriptors)
+        os.replace(tmp_path, os.path.join(self.path, name))
+        with self._lock:
+            self._put(ref_id, features)
+            self._shards[name] = os.path.getmtime(os.path.join(self.path, name))
+
+    def load(self) -> None:
+        with self._lock:
+            self._load()
+
+    def _put(self, ref_id: str, features: KeypointFeatures) -> None:
+        position = self._positions.get(ref_id)
+        if position is None:
+            self._positions[ref_id] = len(self._ids)
+            self._ids.append(ref_id)
+            self._features.append(features)
+        else:
+            self._features[position] = features
+        self._matcher = None
+
+    def _load(self) -> None:
+        """Read the shards added or replaced since the last load."""
+        if not os.path.isdir(self.path):
+            return
+        self._loaded_mtime = os.path.getmtime(self.path)
+        for name in sorted(os.listdir(self.path)):
+            if name.startswith(".") or not name.endswith(".npz"):
+                continue
+            shard_path = os.path.join(self.path, name)
+            mtime = os.path.getmtime(shard_path)
+            if self._shards.get(name) == mtime:
+                continue
+            with np.load(shard_path) as data:
+                self._put(str(data["id"]), KeypointFeatures(points=data["points"], descriptors=data["descriptors"]))
+            self._shards[name] = mtime
+
+    def _ensure_matcher(self) -> Optional[cv2.FlannBasedMatcher]:
+        # Pick up references another worker process added since we last loaded.
+        if os.path.isdir(self.path) and os.path.getmtime(self.path) != self._loaded_mtime:
+            self._load()
+        if self._matcher is None:
+            # FLANN rejects empty descriptor sets; ``_slots`` maps its image index back to ours.
+            self._slots = [idx for idx, f in enumerate(self._features) if len(f.descriptors)]
+            if not self._slots:
+                return None
+            matcher = cv2.FlannBasedMatcher(_LSH_INDEX_PARAMS, _LSH_SEARCH_PARAMS)
+            matcher.add([self._features[idx].descriptors for idx in self._slots])
+            matcher.train()
+            self._matcher = matcher
+        return self._matcher
+
+    def match(
+        self,
+        image: np.ndarray,
+        allowed_ids: Optional[Sequence[str]] = None,
+        context: Optional[FrameContext] = None,
+    ) -> Optional[MatchCandidate]:
+        """Match a frame with one index query plus RANSAC verification.
+
+        The ratio test runs per reference, so near-duplicate templates do not cancel each
+        other's matches, and only over ``allowed_ids``: small allowed sets are matched
+        exactly, larger ones through the index with ``_KNN_NEIGHBOURS`` neighbours per query
+        descriptor. Every survivor votes for its reference; the ``_VERIFY_CANDIDATES`` most
+        voted references are verified with a homography and scored by their inlier count.
+        """
+        gray = context.resized_gray(*match_size(context.image)) if context is not None else _match_gray(image)
+        query = extract_keypoints(gray)
+        if len(query.descriptors) < 2:
+            return None
+        with self._lock:
+            matcher = self._ensure_matcher()
+            if matcher is None:
+                return None
+            ids = list(self._ids)
+            features = list(self._features)
+            slots = list(self._slots)
+            allowed = set(allowed_ids) if allowed_ids is not None else None
+            if allowed is not None and len(allowed) <= _EXACT_MATCH_REFERENCES:
+                knn = None
+            else:
+                knn = matcher.knnMatch(query.descriptors, k=_KNN_NEIGHBOURS)
+
+        if knn is None:
+            pairs = _exact_ratio_pairs(query, features, [idx for idx in slots if ids[idx] in allowed])
+        else:
+            mask = [ids[idx] in allowed for idx in slots] if allowed is not None else None
+            pairs = _indexed_ratio_pairs(knn, slots, mask)
+
+        votes = Counter({idx: len(matches) for idx, matches in pairs.items()})
+        result: Optional[MatchCandidate] = None
+        for idx, good in votes.most_common(_VERIFY_CANDIDATES):
+            inliers = _verify_geometry(query, features[idx], pairs[idx])
+            score = min(100.0, 100.0 * inliers / max(good, _MIN_GOOD_MATCHES))
+            if result is None or score > result.score:
+                result = MatchCandidate(reference_id=ids[idx], score=score)
+        return result
@@ -1,13 +1,38 @@
 from __future__ import annotations
 
+import queue
+from abc import ABC, abstractmethod
 import re
+import threading
+from concurrent.futures import Executor
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+import cv2
 import pytesseract
 from pytesseract import Output
 import numpy as np
 
+from app.pipeline.tamper import zone_to_bbox
+
+try:
+    import tesserocr
+except ImportError:  # optional: in-process engine, needs libtesseract
+    tesserocr = None
+
+
+# Field -> (character whitelist, page segmentation mode) for zone OCR; metadata may override both.
+FIELD_DEFAULTS: Dict[str, Tuple[str, int]] = {
+    "document_number": ("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", 7),
+    "dates": ("0123456789/-.", 7),
+    "exporter": ("", 6),
+    "importer": ("", 6),
+}
+_ZONE_PADDING = 6
+_DEFAULT_PSM = 3
+_MIN_TILE_HEIGHT = 200
+
 
 @dataclass
 class OCRWord:
@@ -43,20 +68,233 @@ def _extract_fields(text: str) -> Dict[str, str]:
     return fields
 
 
-def run_ocr(image: np.ndarray) -> OCRResult:
-    data = pytesseract.image_to_data(image, output_type=Output.DICT)
+class OCREngine(ABC):
+    """Recognises words in a BGR or grayscale image; subclasses pick the Tesseract binding."""
+
+    name = "base"
+
+    @abstractmethod
+    def recognize(self, image: np.ndarray, psm: int = _DEFAULT_PSM, whitelist: str = "") -> List[OCRWord]:
+        """Words in ``image`` using page segmentation mode ``psm``, limited to ``whitelist`` if set."""
+
+    def warm(self) -> None:
+        """Load what the engine needs before the first frame; raises ``RuntimeError`` if it cannot."""
+
+
+class PytesseractEngine(OCREngine):
+    """Runs the ``tesseract`` binary per call through pytesseract (temp file, fork, model load)."""
+
+    name = "pytesseract"
+
+    def recognize(self, image: np.ndarray, psm: int = _DEFAULT_PSM, whitelist: str = "") -> List[OCRWord]:
+        config = f"--psm {psm}"
+        if whitelist:
+            config += f" -c tessedit_char_whitelist={whitelist}"
+        data = pytesseract.image_to_data(image, config=config, output_type=Output.DICT)
+        words: List[OCRWord] = []
+        for i in range(len(data["text"])):
+            text = data["text"][i].strip()
+            conf = float(data["conf"][i]) if data["conf"][i] != "-1" else 0.0
+            if text:
+                bbox = [
+                    int(data["left"][i]),
+                    int(data["top"][i]),
+                    int(data["width"][i]),
+                    int(data["height"][i]),
+                ]
+                words.append(OCRWord(text=text, conf=conf, bbox=bbox))
+        return words
+
+
+class TesserocrEngine(OCREngine):
+    """Pool of long-lived, initialised ``tesserocr`` APIs fed straight from memory.
+
+    Each call borrows one API, so up to ``size`` frames are recognised at once (tesserocr
+    releases the GIL while recognising). APIs are created on demand and kept, so the
+    language model is loaded once per pool slot rather than once per frame.
+    """
+
+    name = "tesserocr"
+
+    def __init__(self, size: int = 1, lang: str = "eng") -> None:
+        if tesserocr is None:
+            raise RuntimeError("tesserocr is not installed")
+        self.size = max(1, size)
+        self.lang = lang
+        self._idle: "queue.Queue[tesserocr.PyTessBaseAPI]" = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _api(self) -> Iterator["tesserocr.PyTessBaseAPI"]:
+        api = None
+        with self._lock:
+            if self._idle.empty() and self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                api = tesserocr.PyTessBaseAPI(lang=self.lang)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        else:
+            api = self._idle.get()
+        try:
+            yield api
+        finally:
+            api.Clear()
+            self._idle.put(api)
+
+    def warm(self) -> None:
+        """Initialise one API, loading the language model, so the first frame does not pay for it."""
+        with self._api():
+            pass
+
+    def recognize(self, image: np.ndarray, psm: int = _DEFAULT_PSM, whitelist: str = "") -> List[OCRWord]:
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gray = np.ascontiguousarray(gray)
+        height, width = gray.shape[:2]
+        words: List[OCRWord] = []
+        with self._api() as api:
+            api.SetPageSegMode(psm)
+            api.SetVariable("tessedit_char_whitelist", whitelist)
+            try:
+                api.SetImageBytes(gray.tobytes(), width, height, 1, width)
+                api.Recognize()
+                level = tesserocr.RIL.WORD
+                for item in tesserocr.iterate_level(api.GetIterator(), level):
+                    text = (item.GetUTF8Text(level) or "").strip()
+                    if not text:
+                        continue
+                    x1, y1, x2, y2 = item.BoundingBox(level)
+                    bbox = [x1, y1, x2 - x1, y2 - y1]
+                    words.append(OCRWord(text=text, conf=float(item.Confidence(level)), bbox=bbox))
+            finally:
+                api.SetPageSegMode(_DEFAULT_PSM)
+                api.SetVariable("tessedit_char_whitelist", "")
+        return words
+
+
+def create_ocr_engine(name: str = "auto", pool_size: int = 1) -> OCREngine:
+    """Build the engine called ``name``; ``"auto"`` prefers tesserocr and falls back to pytesseract."""
+    if name == "pytesseract" or (name == "auto" and tesserocr is None):
+        return PytesseractEngine()
+    if name not in ("auto", "tesserocr"):
+        raise ValueError(f"Unknown OCR engine: {name}")
+    engine = TesserocrEngine(size=pool_size)
+    try:
+        engine.warm()
+    except RuntimeError:
+        if name == "tesserocr":
+            raise
+        return PytesseractEngine()
+    return engine
+
+
+def _tile_bands(height: int, tiles: int, overlap: int) -> List[Tuple[int, int, int, int]]:
+    """Split ``height`` rows into overlapping bands as ``(start, end, own_start, own_end)``.
+
+    Each band owns the rows up to the middle of its overlaps, so a word seen in two bands
+    is kept only by the band that owns its vertical centre.
+    """
+    tiles = max(1, min(tiles, height // _MIN_TILE_HEIGHT))
+    cuts = [round(height * index / tiles) for index in range(tiles + 1)]
+    half = overlap // 2
+    bands = []
+    for index in range(tiles):
+        own_start, own_end = cuts[index], cuts[index + 1]
+        start = own_start if index == 0 else max(0, own_start - half)
+        end = own_end if index == tiles - 1 else min(height, own_end + half)
+        bands.append((start, end, own_start, own_end))
+    return bands
+
+
+def _recognize_tiled(
+    image: np.ndarray,
+    engine: OCREngine,
+    tiles: int,
+    overlap: int,
+    executor: Optional[Executor],
+) -> List[OCRWord]:
+    bands = _tile_bands(image.shape[0], tiles, overlap)
+    crops = [image[start:end] for start, end, _, _ in bands]
+    results = executor.map(engine.recognize, crops) if executor is not None else map(engine.recognize, crops)
     words: List[OCRWord] = []
-    for i in range(len(data["text"])):
-        text = data["text"][i].strip()
-        conf = float(data["conf"][i]) if data["conf"][i] != "-1" else 0.0
-        if text:
-            bbox = [
-                int(data["left"][i]),
-                int(data["top"][i]),
-                int(data["width"][i]),
-                int(data["height"][i]),
-            ]
-            words.append(OCRWord(text=text, conf=conf, bbox=bbox))
+    for (start, _, own_start, own_end), band_words in zip(bands, results):
+        for word in band_words:
+            word.bbox = [word.bbox[0], word.bbox[1] + start, word.bbox[2], word.bbox[3]]
+            if own_start <= word.bbox[1] + word.bbox[3] / 2.0 < own_end:
+                words.append(word)
+    return words
+
+
+def run_ocr(
+    image: np.ndarray,
+    engine: Optional[OCREngine] = None,
+    tiles: int = 1,
+    overlap: int = 64,
+    executor: Optional[Executor] = None,
+) -> OCRResult:
+    """Full-page OCR, optionally as ``tiles`` overlapping horizontal bands read on ``executor``.
+
+    Bands overlap by ``overlap`` pixels, which should exceed the tallest text line so
+    every word lies whole inside the band that keeps it. Words come back in page
+    coordinates and top-to-bottom band order.
+    """
+    engine = engine or PytesseractEngine()
+    if tiles > 1:
+        words = _recognize_tiled(image, engine, tiles, overlap, executor)
+    else:
+        words = engine.recognize(image)
     full_text = "\n".join([word.text for word in words])
     extracted_fields = _extract_fields(full_text)
     return OCRResult(full_text=full_text, words=words, extracted_fields=extracted_fields)
+
+
+def ocr_quality_score(result: OCRResult, field_zones: Optional[Dict[str, Any]] = None) -> float:
+    """0-100 OCR quality of ``result``.
+
+    Full-page OCR scores 1.5 per recognised word. Zone OCR (``field_zones`` given) reads
+    a handful of short fields, so it scores the share of declared fields that yielded text.
+    """
+    if field_zones:
+        return 100.0 * len(result.extracted_fields) / len(field_zones)
+    return float(min(100.0, len(result.words) * 1.5))
+
+
+def run_zone_ocr(image: np.ndarray, field_zones: Dict[str, Any], engine: Optional[OCREngine] = None) -> OCRResult:
+    """OCR only the declared field zones of a rectified page, one crop per field.
+
+    ``field_zones`` maps a field name to a zone (``x``/``y``/``w``/``h``, relative or in
+    pixels, as for watermark zones) with optional ``whitelist`` and ``psm`` overriding
+    ``FIELD_DEFAULTS``. Word boxes are returned in page coordinates and each field's
+    text becomes its extracted value.
+    """
+    engine = engine or PytesseractEngine()
+    height, width = image.shape[:2]
+    words: List[OCRWord] = []
+    extracted_fields: Dict[str, str] = {}
+    for field_name, zone in field_zones.items():
+        default_whitelist, default_psm = FIELD_DEFAULTS.get(field_name, ("", 6))
+        x, y, w, h = zone_to_bbox(zone, image.shape)
+        x0, y0 = max(0, x - _ZONE_PADDING), max(0, y - _ZONE_PADDING)
+        x1, y1 = min(width, x + w + _ZONE_PADDING), min(height, y + h + _ZONE_PADDING)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        zone_words = engine.recognize(
+            image[y0:y1, x0:x1],
+            psm=int(zone.get("psm", default_psm)),
+            whitelist=str(zone.get("whitelist", default_whitelist)),
+        )
+        for word in zone_words:
+            word.bbox = [word.bbox[0] + x0, word.bbox[1] + y0, word.bbox[2], word.bbox[3]]
+        words.extend(zone_words)
+        text = " ".join(word.text for word in zone_words)
+        if text:
+            extracted_fields[field_name] = text
+    full_text = "\n".join([word.text for word in words])
+    return OCRResult(full_text=full_text, words=words, extracted_fields=extracted_fields)
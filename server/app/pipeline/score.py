@@ -18,8 +18,12 @@ def compute_scores(
     ocr_quality_score: float,
     tamper_risk_score: float,
     quality: QualityResult,
+    degraded: bool = False,
 ) -> ScoreResult:
-    if quality.acceptable and match_score > 75:
+    """Combine stage scores; a ``degraded`` analysis (OCR and tamper skipped) is always "low"."""
+    if degraded:
+        confidence_band = "low"
+    elif quality.acceptable and match_score > 75:
         confidence_band = "high"
     elif match_score > 55:
         confidence_band = "medium"
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import cv2
+import numpy as np
+
+# Same defaults as skimage.metrics.structural_similarity on uint8 input, so batched
+# scores agree with the per-pair skimage path to within 1e-5 SSIM (1e-3 score points).
+WIN_SIZE = 7
+DATA_RANGE = 255.0
+_C1 = (0.01 * DATA_RANGE) ** 2
+_C2 = (0.03 * DATA_RANGE) ** 2
+_COV_NORM = WIN_SIZE * WIN_SIZE / (WIN_SIZE * WIN_SIZE - 1.0)
+_PAD = (WIN_SIZE - 1) // 2
+_BATCH_SIZE = 16
+
+
+@dataclass
+class Moments:
+    """Local (WIN_SIZE x WIN_SIZE window) mean and mean-of-squares maps of a grayscale image."""
+
+    mean: np.ndarray
+    sq_mean: np.ndarray
+
+    @property
+    def nbytes(self) -> int:
+        return self.mean.nbytes + self.sq_mean.nbytes
+
+
+def _box(data: np.ndarray) -> np.ndarray:
+    filtered = cv2.boxFilter(data, cv2.CV_32F, (WIN_SIZE, WIN_SIZE), borderType=cv2.BORDER_REFLECT)
+    return filtered.reshape(data.shape)
+
+
+def local_moments(gray: np.ndarray) -> Moments:
+    data = gray.astype(np.float32)
+    return Moments(mean=_box(data), sq_mean=_box(data * data))
+
+
+def _ssim_from_moments(
+    mu_x: np.ndarray,
+    xx: np.ndarray,
+    mu_y: np.ndarray,
+    yy: np.ndarray,
+    xy: np.ndarray,
+) -> np.ndarray:
+    """SSIM from local moments. ``mu_y``, ``yy`` and ``xy`` are overwritten to avoid temporaries."""
+    mu_x_sq = mu_x * mu_x
+    var_x = xx - mu_x_sq
+    numerator = mu_x * mu_y
+    np.subtract(xy, numerator, out=xy)
+    xy *= 2.0 * _COV_NORM
+    xy += _C2
+    numerator *= 2.0
+    numerator += _C1
+    numerator *= xy
+
+    np.multiply(mu_y, mu_y, out=mu_y)
+    np.subtract(yy, mu_y, out=yy)
+    yy += var_x
+    yy *= _COV_NORM
+    yy += _C2
+    mu_y += mu_x_sq
+    mu_y += _C1
+    mu_y *= yy
+    numerator /= mu_y
+    return numerator
+
+
+def _ssim_block(
+    query: np.ndarray,
+    moments: Moments,
+    block: np.ndarray,
+    block_moments: Sequence[Optional[Moments]],
+) -> np.ndarray:
+    """Mean SSIM of ``query`` (H, W) against every channel of ``block`` (H, W, N).
+
+    Channels with precomputed ``block_moments`` only pay for the cross term; the rest
+    have their local moments filtered here, together.
+    """
+    height = block.shape[0]
+    interior = (slice(_PAD, height - _PAD), slice(_PAD, block.shape[1] - _PAD))
+
+    xy = _box(query[:, :, None] * block)[interior]
+    mu_y = np.empty_like(xy)
+    yy = np.empty_like(xy)
+    missing = [slot for slot, precomputed in enumerate(block_moments) if precomputed is None]
+    if missing:
+        uncached = block[:, :, missing]
+        mu_y[:, :, missing] = _box(uncached)[interior]
+        yy[:, :, missing] = _box(uncached * uncached)[interior]
+    for slot, precomputed in enumerate(block_moments):
+        if precomputed is not None:
+            mu_y[:, :, slot] = precomputed.mean[:height][interior]
+            yy[:, :, slot] = precomputed.sq_mean[:height][interior]
+    mu_x = moments.mean[:height][interior][:, :, None]
+    xx = moments.sq_mean[:height][interior][:, :, None]
+    return _ssim_from_moments(mu_x, xx, mu_y, yy, xy).mean(axis=(0, 1), dtype=np.float64)
+
+
+def ssim_map(gray_a: np.ndarray, gray_b: np.ndarray, moments_b: Optional[Moments] = None) -> np.ndarray:
+    """Per-pixel SSIM map of two same-size grayscale images (float32, reflect-padded borders).
+
+    Pass the precomputed ``local_moments`` of ``gray_b`` to skip filtering it again.
+    """
+    data_a = gray_a.astype(np.float32)
+    data_b = gray_b.astype(np.float32)
+    moments_a = local_moments(data_a)
+    if moments_b is None:
+        moments_b = local_moments(data_b)
+    xy = _box(data_a * data_b)
+    return _ssim_from_moments(
+        moments_a.mean,
+        moments_a.sq_mean,
+        moments_b.mean.copy(),
+        moments_b.sq_mean.copy(),
+        xy,
+    )
+
+
+def batch_ssim(
+    query: np.ndarray,
+    references: Sequence[np.ndarray],
+    reference_moments: Optional[Sequence[Optional[Moments]]] = None,
+    query_moments: Optional[Moments] = None,
+) -> np.ndarray:
+    """Mean SSIM of a grayscale query against each same-width grayscale reference.
+
+    Each pair is compared over the rows they share (the shorter height), as the match
+    stage always has. The query's moment maps are computed once; references are stacked
+    into contiguous float32 blocks and filtered together, _BATCH_SIZE at a time.
+    ``reference_moments`` may supply each reference's precomputed ``local_moments``, and
+    ``query_moments`` the query's; cropping never changes the interior values that are
+    averaged, so they stay valid.
+    """
+    if reference_moments is None:
+        reference_moments = [None] * len(references)
+    scores = np.zeros(len(references), dtype=np.float64)
+    query_f = query.astype(np.float32)
+    moments = query_moments if query_moments is not None else local_moments(query_f)
+
+    groups: Dict[int, List[int]] = {}
+    for idx, reference in enumerate(references):
+        groups.setdefault(min(query.shape[0], reference.shape[0]), []).append(idx)
+
+    for height, indices in groups.items():
+        for start in range(0, len(indices), _BATCH_SIZE):
+            chunk = indices[start : start + _BATCH_SIZE]
+            block = np.empty((height, query.shape[1], len(chunk)), dtype=np.float32)
+            for slot, idx in enumerate(chunk):
+                block[:, :, slot] = references[idx][:height]
+            block_moments = [reference_moments[idx] for idx in chunk]
+            scores[chunk] = _ssim_block(query_f[:height], moments, block, block_moments)
+    return scores
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.pipeline.frame import FrameContext
+from app.pipeline.quality import QualityResult, assess_quality, recapture_hints
+from app.pipeline.rectify import detect_document_corners
+
+
+@dataclass
+class FrameCheck:
+    index: int
+    quality: QualityResult
+    hints: List[Dict[str, str]]
+    corners_found: bool
+    stable_frames: int
+    ready: bool
+
+
+@dataclass
+class FrameCandidate:
+    index: int
+    score: float
+    payload: Any
+
+
+class FrameSelector:
+    """Picks the frame worth a full pipeline run from a live stream of preview frames.
+
+    Each frame only gets the cheap checks: ``assess_quality`` and a boundary detection at
+    ``detect_max_side``. Frames that pass the quality thresholds and whose corners move
+    less than ``corner_tolerance`` (a fraction of the frame diagonal) since the previous
+    frame extend a stable streak; the sharpest, least glary frame of the streak is kept.
+    ``ready`` turns true once the streak reaches ``stable_frames``.
+    """
+
+    def __init__(
+        self,
+        min_blur: float,
+        max_glare: float,
+        stable_frames: int = 3,
+        corner_tolerance: float = 0.02,
+        detect_max_side: int = 480,
+    ) -> None:
+        self.min_blur = min_blur
+        self.max_glare = max_glare
+        self.stable_frames = max(1, stable_frames)
+        self.corner_tolerance = corner_tolerance
+        self.detect_max_side = detect_max_side
+        self.frames = 0
+        self._previous: Optional[np.ndarray] = None
+        self._streak = 0
+        self._best: Optional[FrameCandidate] = None
+        self._fallback: Optional[FrameCandidate] = None
+
+    def add(self, image: np.ndarray, payload: Any = None) -> FrameCheck:
+        """Check one frame; ``payload`` (e.g. the encoded upload) is kept if it becomes the candidate."""
+        index = self.frames
+        self.frames += 1
+        context = FrameContext(image)
+        quality = assess_quality(image, context=context)
+        hints = recapture_hints(quality, self.min_blur, self.max_glare)
+        corners = detect_document_corners(image, self.detect_max_side, context=context)
+        if corners is None:
+            hints.append({"code": "boundary", "hint": "Fit all four edges of the document inside the frame"})
+            self._previous = None
+            self._streak = 0
+            self._best = None
+            return FrameCheck(index, quality, hints, corners_found=False, stable_frames=0, ready=False)
+
+        normalized = corners / np.array([image.shape[1], image.shape[0]], dtype=np.float32)
+        moved = (
+            float(np.max(np.linalg.norm(normalized - self._previous, axis=1))) / np.sqrt(2.0)
+            if self._previous is not None
+            else 0.0
+        )
+        self._previous = normalized
+        candidate = FrameCandidate(index, quality.blur_score * (1.0 - quality.glare_ratio), payload)
+        if self._fallback is None or candidate.score > self._fallback.score:
+            self._fallback = candidate
+
+        if hints or moved > self.corner_tolerance:
+            if moved > self.corner_tolerance:
+                hints.append({"code": "motion", "hint": "Hold the camera still over the document"})
+            self._streak = 0
+            self._best = None
+        else:
+            self._streak += 1
+            if self._best is None or candidate.score > self._best.score:
+                self._best = candidate
+        ready = self._streak >= self.stable_frames
+        return FrameCheck(index, quality, hints, corners_found=True, stable_frames=self._streak, ready=ready)
+
+    def best(self) -> Optional[FrameCandidate]:
+        """The best frame of the current stable streak, else the best frame with a detected boundary."""
+        return self._best or self._fallback
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
+import time
 from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
-from skimage.metrics import structural_similarity as ssim
+
+from app.pipeline.frame import FrameContext
+from app.pipeline.match import PreparedReference
+from app.pipeline.ssim import ssim_map
 
 
 @dataclass
@@ -17,13 +21,23 @@ class Finding:
     score: float
 
 
+_LAYOUT_THRESHOLD = 0.65
+# Adaptive mode: a pixel changed if it leaves the other image's min/max over _ENVELOPE
+# (i.e. no shift of up to 2 px explains it) by more than _CHANGE_TOLERANCE grey levels.
+_CHANGE_TOLERANCE = 48
+_ENVELOPE = np.ones((5, 5), dtype=np.uint8)
+_SPECKLE = np.ones((2, 2), dtype=np.uint8)
+_ALIGN_MARGIN = 8
+_ALIGN_MAX_SHIFT = 4.0
+
+
 @dataclass
 class TamperResult:
     findings: List[Finding]
     tamper_score: float
 
 
-def _zone_to_bbox(zone: Dict[str, float], image_shape: Tuple[int, int]) -> List[int]:
+def zone_to_bbox(zone: Dict[str, float], image_shape: Tuple[int, int]) -> List[int]:
     height, width = image_shape[:2]
     x = zone.get("x", 0.0)
     y = zone.get("y", 0.0)
@@ -34,51 +48,207 @@ def _zone_to_bbox(zone: Dict[str, float], image_shape: Tuple[int, int]) -> List[
     return [int(x), int(y), int(w), int(h)]
 
 
-def _ssim_region(image_a: np.ndarray, image_b: np.ndarray, bbox: List[int]) -> float:
+def _map_region(bbox: List[int], scale: Tuple[float, float], shape: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """``bbox`` (frame coordinates) as ``(x0, y0, x1, y1)`` on a canonical-size map of ``shape``."""
+    height, width = shape
     x, y, w, h = bbox
-    patch_a = image_a[y : y + h, x : x + w]
-    patch_b = image_b[y : y + h, x : x + w]
-    if patch_a.size == 0 or patch_b.size == 0:
+    scale_x, scale_y = scale
+    x0, y0 = max(0, min(round(x * scale_x), width)), max(0, min(round(y * scale_y), height))
+    x1, y1 = max(0, min(round((x + w) * scale_x), width)), max(0, min(round((y + h) * scale_y), height))
+    return x0, y0, x1, y1
+
+
+def _region_mean(integral: np.ndarray, bbox: List[int], scale: Tuple[float, float]) -> float:
+    """Mean of a canonical-size map (SSIM or change mask) over ``bbox``, read in O(1) from its integral image.
+
+    ``bbox`` is in frame coordinates; ``scale`` maps it onto the canonical-size map.
+    """
+    x0, y0, x1, y1 = _map_region(bbox, scale, (integral.shape[0] - 1, integral.shape[1] - 1))
+    if x1 <= x0 or y1 <= y0:
         return 1.0
-    gray_a = cv2.cvtColor(patch_a, cv2.COLOR_BGR2GRAY)
-    gray_b = cv2.cvtColor(patch_b, cv2.COLOR_BGR2GRAY)
-    return float(ssim(gray_a, gray_b))
+    total = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return float(total / ((x1 - x0) * (y1 - y0)))
 
 
-def analyze_tamper(
+def _cell_changes(gray: np.ndarray, reference_gray: np.ndarray, region: Tuple[int, int, int, int]) -> np.ndarray:
+    """Mask of the pixels in canonical ``region`` that changed beyond misregistration.
+
+    A pixel counts as changed when either image leaves the other's ``_ENVELOPE`` min/max
+    by more than ``_CHANGE_TOLERANCE``, which sub-pixel shifts and JPEG noise do not do;
+    specks thinner than ``_SPECKLE`` are dropped. If anything changed, the reference crop
+    is aligned to the frame by phase correlation and the mask recomputed: a coarse cell
+    is small enough that a slight rotation is a translation there.
+    """
+    height, width = gray.shape[:2]
+    x0, y0, x1, y1 = region
+    px0, py0 = max(0, x0 - _ALIGN_MARGIN), max(0, y0 - _ALIGN_MARGIN)
+    px1, py1 = min(width, x1 + _ALIGN_MARGIN), min(height, y1 + _ALIGN_MARGIN)
+    frame = gray[py0:py1, px0:px1]
+    reference = reference_gray[py0:py1, px0:px1]
+    changed = _changed_pixels(frame, reference)
+    if changed.any():
+        window = cv2.createHanningWindow((frame.shape[1], frame.shape[0]), cv2.CV_32F)
+        (dx, dy), _ = cv2.phaseCorrelate(reference.astype(np.float32), frame.astype(np.float32), window)
+        if np.isfinite(dx) and np.isfinite(dy) and max(abs(dx), abs(dy)) <= _ALIGN_MAX_SHIFT:
+            shift = np.float32([[1, 0, dx], [0, 1, dy]])
+            size = (frame.shape[1], frame.shape[0])
+            changed = _changed_pixels(frame, cv2.warpAffine(reference, shift, size, borderMode=cv2.BORDER_REPLICATE))
+    return changed[y0 - py0 : y1 - py0, x0 - px0 : x1 - px0]
+
+
+def _changed_pixels(frame: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    frame_values, reference_values = frame.astype(np.int16), reference.astype(np.int16)
+    outside_reference = np.maximum(
+        frame_values - cv2.dilate(reference, _ENVELOPE), cv2.erode(reference, _ENVELOPE) - frame_values
+    )
+    outside_frame = np.maximum(
+        reference_values - cv2.dilate(frame, _ENVELOPE), cv2.erode(frame, _ENVELOPE) - reference_values
+    )
+    changed = (np.maximum(outside_reference, outside_frame) > _CHANGE_TOLERANCE).astype(np.uint8)
+    return cv2.morphologyEx(changed, cv2.MORPH_OPEN, _SPECKLE)
+
+
+def _layout_finding(bbox: List[int], score: float) -> Finding:
+    return Finding(
+        category="layout",
+        severity="medium",
+        message="Region differs from reference pattern",
+        bbox=bbox,
+        score=float(1.0 - score),
+    )
+
+
+def _split_cell(bbox: List[int]) -> List[List[int]]:
+    x, y, w, h = bbox
+    left, top = w // 2, h // 2
+    return [
+        [x, y, left, top],
+        [x + left, y, w - left, top],
+        [x, y + top, left, h - top],
+        [x + left, y + top, w - left, h - top],
+    ]
+
+
+def _refine_cell(
+    changes: np.ndarray,
+    integral: np.ndarray,
+    bbox: List[int],
+    scale: Tuple[float, float],
+    min_cell: int,
+    deadline: float,
+) -> List[Finding]:
+    """Quadtree-refine a cell with changed pixels into the tightest boxes that hold them.
+
+    ``changes`` and ``integral`` are the integral images of the change mask (see
+    ``_cell_changes``) and of the SSIM map.
+    Quadrants holding changed pixels are explored recursively while they can be split
+    without going under ``min_cell`` pixels and the time budget lasts; a cell that cannot
+    be split further is reported, scored by its mean SSIM.
+    """
+    x, y, w, h = bbox
+    if w // 2 >= min_cell and h // 2 >= min_cell and time.perf_counter() < deadline:
+        findings: List[Finding] = []
+        for child in _split_cell(bbox):
+            if _region_mean(changes, child, scale) > 0.0:
+                findings.extend(_refine_cell(changes, integral, child, scale, min_cell, deadline))
+        if findings:
+            return findings
+    return [_layout_finding(bbox, min(1.0, _region_mean(integral, bbox, scale)))]
+
+
+def _touching(a: List[int], b: List[int]) -> bool:
+    return a[0] <= b[0] + b[2] and b[0] <= a[0] + a[2] and a[1] <= b[1] + b[3] and b[1] <= a[1] + a[3]
+
+
+def _merge_layout_findings(findings: List[Finding]) -> List[Finding]:
+    """Merge touching layout boxes from one coarse cell's quadtree into one box per connected region."""
+    merged: List[Finding] = []
+    for finding in findings:
+        bbox, score = list(finding.bbox), finding.score
+        absorbed = True
+        while absorbed:
+            absorbed = False
+            for other in list(merged):
+                if _touching(bbox, other.bbox):
+                    x0, y0 = min(bbox[0], other.bbox[0]), min(bbox[1], other.bbox[1])
+                    x1 = max(bbox[0] + bbox[2], other.bbox[0] + other.bbox[2])
+                    y1 = max(bbox[1] + bbox[3], other.bbox[1] + other.bbox[3])
+                    bbox, score = [x0, y0, x1 - x0, y1 - y0], max(score, other.score)
+                    merged.remove(other)
+                    absorbed = True
+        merged.append(_layout_finding(bbox, 1.0 - score))
+    return merged
+
+
+def analyze_layout(
     image: np.ndarray,
-    reference_image: np.ndarray,
+    reference: PreparedReference,
     metadata: Dict[str, object],
-    ocr_boxes: List[List[int]],
+    mode: str = "grid",
+    min_cell: int = 24,
+    time_budget_ms: float = 50.0,
+    context: Optional[FrameContext] = None,
 ) -> TamperResult:
+    """Layout and watermark checks of ``image`` in the reference's canonical (match-width) space.
+
+    The frame is resized to the reference's canonical grayscale copy, so the reference's
+    precomputed moment maps are reused and only frame-side and cross terms are filtered.
+    With a ``context`` for ``image`` that view comes from the shared frame context (warped
+    there directly when the rectifier provided one). Findings are reported in frame
+    coordinates.
+
+    In ``"adaptive"`` mode cells are screened by a change mask that tolerates sub-pixel
+    misregistration (see ``_cell_changes``) instead of their mean SSIM, so a single
+    changed glyph, which barely moves a coarse cell's mean, still stands out. Cells with
+    changed pixels are refined into tighter boxes (see ``_refine_cell``) within
+    ``time_budget_ms`` of building the SSIM map; touching boxes are merged only within
+    their own coarse cell. The tamper score counts coarse cells with findings.
+    """
     findings: List[Finding] = []
 
-    resized_ref = cv2.resize(reference_image, (image.shape[1], image.shape[0]))
+    canonical_h, canonical_w = reference.gray.shape[:2]
+    if context is not None:
+        gray = context.resized_gray(canonical_w, canonical_h)
+    else:
+        gray = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (canonical_w, canonical_h))
+    similarity = ssim_map(gray, reference.gray, reference.moments)
+    integral = cv2.integral(similarity, sdepth=cv2.CV_64F)
+    scale = (canonical_w / float(image.shape[1]), canonical_h / float(image.shape[0]))
 
     grid_rows = 6
     grid_cols = 8
     cell_w = image.shape[1] // grid_cols
     cell_h = image.shape[0] // grid_rows
+    cells = [[col * cell_w, row * cell_h, cell_w, cell_h] for row in range(grid_rows) for col in range(grid_cols)]
 
-    for row in range(grid_rows):
-        for col in range(grid_cols):
-            bbox = [col * cell_w, row * cell_h, cell_w, cell_h]
-            score = _ssim_region(image, resized_ref, bbox)
-            if score < 0.65:
-                findings.append(
-                    Finding(
-                        category="layout",
-                        severity="medium",
-                        message="Region differs from reference pattern",
-                        bbox=bbox,
-                        score=float(1.0 - score),
-                    )
-                )
+    if mode == "adaptive":
+        changed = np.zeros((canonical_h, canonical_w), dtype=np.uint8)
+        for bbox in cells:
+            x0, y0, x1, y1 = _map_region(bbox, scale, (canonical_h, canonical_w))
+            if x1 > x0 and y1 > y0:
+                changed[y0:y1, x0:x1] = _cell_changes(gray, reference.gray, (x0, y0, x1, y1))
+        changes = cv2.integral(changed, sdepth=cv2.CV_64F)
+    deadline = time.perf_counter() + time_budget_ms / 1000.0
+
+    flagged_cells = 0
+    for bbox in cells:
+        if mode == "adaptive":
+            if _region_mean(changes, bbox, scale) <= 0.0:
+                continue
+            cell_findings = _merge_layout_findings(_refine_cell(changes, integral, bbox, scale, min_cell, deadline))
+        else:
+            score = _region_mean(integral, bbox, scale)
+            if score >= _LAYOUT_THRESHOLD:
+                continue
+            cell_findings = [_layout_finding(bbox, score)]
+        flagged_cells += 1 if cell_findings else 0
+        findings.extend(cell_findings)
+    layout_findings = len(findings)
 
     watermark_zones = metadata.get("watermark_zones", []) if isinstance(metadata, dict) else []
     for zone in watermark_zones:
-        bbox = _zone_to_bbox(zone, image.shape)
-        score = _ssim_region(image, resized_ref, bbox)
+        bbox = zone_to_bbox(zone, image.shape)
+        score = _region_mean(integral, bbox, scale)
         if score < 0.7:
             findings.append(
                 Finding(
@@ -90,6 +260,13 @@ def analyze_tamper(
                 )
             )
 
+    tamper_score = min(100.0, float((flagged_cells + len(findings) - layout_findings) * 8))
+    return TamperResult(findings=findings, tamper_score=tamper_score)
+
+
+def analyze_typography(ocr_boxes: List[List[int]]) -> TamperResult:
+    """Typography consistency check; the only tamper check that needs the OCR word boxes."""
+    findings: List[Finding] = []
     if ocr_boxes:
         heights = [bbox[3] for bbox in ocr_boxes]
         median_height = float(np.median(heights)) if heights else 0.0
@@ -105,6 +282,24 @@ def analyze_tamper(
                         score=min(1.0, variance / (median_height * 10.0)),
                     )
                 )
+    return TamperResult(findings=findings, tamper_score=float(len(findings) * 8))
 
-    tamper_score = min(100.0, float(len(findings) * 8))
+
+def combine_tamper(*results: TamperResult) -> TamperResult:
+    findings = [finding for result in results for finding in result.findings]
+    tamper_score = min(100.0, sum(result.tamper_score for result in results))
     return TamperResult(findings=findings, tamper_score=tamper_score)
+
+
+def analyze_tamper(
+    image: np.ndarray,
+    reference: PreparedReference,
+    metadata: Dict[str, object],
+    ocr_boxes: List[List[int]],
+    mode: str = "grid",
+    min_cell: int = 24,
+    time_budget_ms: float = 50.0,
+) -> TamperResult:
+    """All tamper checks in one call; see ``analyze_layout`` and ``analyze_typography``."""
+    layout = analyze_layout(image, reference, metadata, mode=mode, min_cell=min_cell, time_budget_ms=time_budget_ms)
+    return combine_tamper(layout, analyze_typography(ocr_boxes))
@@ -3,8 +3,8 @@ from __future__ import annotations
 import json
 import os
 import sqlite3
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 from app.config import settings
 
@@ -20,7 +20,7 @@ def init_db() -> None:
     with _connect() as conn:
         conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS references (
+            CREATE TABLE IF NOT EXISTS "references" (
                 id TEXT PRIMARY KEY,
                 doc_type TEXT NOT NULL,
                 version TEXT NOT NULL,
@@ -30,6 +30,22 @@ def init_db() -> None:
             )
             """
         )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_references_doc_type_version ON "references" (doc_type, version)'
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS reference_features (
+                reference_id TEXT PRIMARY KEY,
+                offset INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                dtype TEXT NOT NULL,
+                descriptor BLOB NOT NULL,
+                created_at TEXT NOT NULL
+            )
+            """
+        )
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS sessions (
@@ -43,6 +59,34 @@ def init_db() -> None:
             )
             """
         )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS result_cache (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_created_at ON result_cache (created_at)")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                doc_type TEXT,
+                version TEXT,
+                upload_path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                heartbeat_at TEXT,
+                finished_at TEXT
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created_at ON jobs (status, created_at)")
         conn.commit()
 
 
@@ -57,7 +101,7 @@ def add_reference(
     with _connect() as conn:
         conn.execute(
             """
-            INSERT INTO references (id, doc_type, version, metadata, image_path, created_at)
+            INSERT INTO "references" (id, doc_type, version, metadata, image_path, created_at)
             VALUES (?, ?, ?, ?, ?, ?)
             """,
             (ref_id, doc_type, version, json.dumps(metadata), image_path, created_at),
@@ -65,18 +109,75 @@ def add_reference(
         conn.commit()
 
 
-def list_references() -> List[Dict[str, Any]]:
+def list_references(doc_type: Optional[str] = None, version: Optional[str] = None) -> List[Dict[str, Any]]:
+    clauses = []
+    params: List[str] = []
+    if doc_type is not None:
+        clauses.append("r.doc_type = ?")
+        params.append(doc_type)
+    if version is not None:
+        clauses.append("r.version = ?")
+        params.append(version)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
     with _connect() as conn:
-        rows = conn.execute("SELECT * FROM references ORDER BY created_at DESC").fetchall()
+        rows = conn.execute(
+            f"""
+            SELECT r.*, f.offset AS feature_offset, f.height AS feature_height,
+                   f.width AS feature_width, f.dtype AS feature_dtype
+            FROM "references" r
+            LEFT JOIN reference_features f ON f.reference_id = r.id
+            {where}
+            ORDER BY r.created_at DESC
+            """,
+            params,
+        ).fetchall()
         return [dict(row) for row in rows]
 
 
 def get_reference(ref_id: str) -> Optional[Dict[str, Any]]:
     with _connect() as conn:
-        row = conn.execute("SELECT * FROM references WHERE id = ?", (ref_id,)).fetchone()
+        row = conn.execute('SELECT * FROM "references" WHERE id = ?', (ref_id,)).fetchone()
         return dict(row) if row else None
 
 
+def list_reference_descriptors(ref_ids: Optional[Sequence[str]] = None) -> List[Tuple[str, bytes]]:
+    """``(reference_id, descriptor)`` pairs, for every reference or only ``ref_ids``."""
+    with _connect() as conn:
+        if ref_ids is None:
+            rows = conn.execute("SELECT reference_id, descriptor FROM reference_features").fetchall()
+            return [(row["reference_id"], row["descriptor"]) for row in rows]
+        pairs: List[Tuple[str, bytes]] = []
+        for start in range(0, len(ref_ids), 500):
+            chunk = list(ref_ids[start : start + 500])
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT reference_id, descriptor FROM reference_features WHERE reference_id IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            pairs.extend((row["reference_id"], row["descriptor"]) for row in rows)
+        return pairs
+
+
+def add_reference_features(
+    ref_id: str,
+    offset: int,
+    shape: Tuple[int, int],
+    dtype: str,
+    descriptor: bytes,
+) -> None:
+    created_at = datetime.utcnow().isoformat()
+    with _connect() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO reference_features
+                (reference_id, offset, height, width, dtype, descriptor, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (ref_id, offset, shape[0], shape[1], dtype, descriptor, created_at),
+        )
+        conn.commit()
+
+
 def create_session(session_id: str, doc_type: Optional[str]) -> None:
     created_at = datetime.utcnow().isoformat()
     with _connect() as conn:
@@ -121,3 +222,127 @@ def get_session(session_id: str) -> Optional[Dict[str, Any]]:
     with _connect() as conn:
         row = conn.execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
         return dict(row) if row else None
+
+
+def reference_set_stamp() -> str:
+    """Cheap version stamp of the reference set; changes whenever a reference is added."""
+    with _connect() as conn:
+        row = conn.execute('SELECT COUNT(*) AS total, MAX(created_at) AS latest FROM "references"').fetchone()
+        return f"{row['total']}:{row['latest']}"
+
+
+def get_cached_result(key: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
+    cutoff = (datetime.utcnow() - timedelta(seconds=ttl_seconds)).isoformat()
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT result FROM result_cache WHERE key = ? AND created_at >= ?",
+            (key, cutoff),
+        ).fetchone()
+        return json.loads(row["result"]) if row else None
+
+
+def put_cached_result(key: str, result: Dict[str, Any], ttl_seconds: int, max_entries: int) -> None:
+    """Store ``result`` under ``key``, dropping expired entries and the oldest beyond ``max_entries``."""
+    now = datetime.utcnow()
+    cutoff = (now - timedelta(seconds=ttl_seconds)).isoformat()
+    with _connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO result_cache (key, result, created_at) VALUES (?, ?, ?)",
+            (key, json.dumps(result), now.isoformat()),
+        )
+        conn.execute("DELETE FROM result_cache WHERE created_at < ?", (cutoff,))
+        conn.execute(
+            """
+            DELETE FROM result_cache WHERE key NOT IN (
+                SELECT key FROM result_cache ORDER BY created_at DESC LIMIT ?
+            )
+            """,
+            (max_entries,),
+        )
+        conn.commit()
+
+
+def clear_result_cache() -> None:
+    with _connect() as conn:
+        conn.execute("DELETE FROM result_cache")
+        conn.commit()
+
+
+def add_job(
+    job_id: str,
+    session_id: str,
+    doc_type: Optional[str],
+    version: Optional[str],
+    upload_path: str,
+) -> None:
+    created_at = datetime.utcnow().isoformat()
+    with _connect() as conn:
+        conn.execute(
+            """
+            INSERT INTO jobs (id, session_id, doc_type, version, upload_path, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (job_id, session_id, doc_type, version, upload_path, "queued", created_at),
+        )
+        conn.commit()
+
+
+def count_jobs(status: str) -> int:
+    with _connect() as conn:
+        row = conn.execute("SELECT COUNT(*) AS total FROM jobs WHERE status = ?", (status,)).fetchone()
+        return row["total"]
+
+
+def claim_job() -> Optional[Dict[str, Any]]:
+    """Atomically mark the oldest queued job as running and return it, or ``None`` if none is queued."""
+    started_at = datetime.utcnow().isoformat()
+    with _connect() as conn:
+        row = conn.execute(
+            """
+            UPDATE jobs SET status = 'running', started_at = ?, heartbeat_at = ?
+            WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)
+            RETURNING *
+            """,
+            (started_at, started_at),
+        ).fetchone()
+        conn.commit()
+        return dict(row) if row else None
+
+
+def finish_job(job_id: str, status: str, error: Optional[str] = None) -> None:
+    finished_at = datetime.utcnow().isoformat()
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, error, finished_at, job_id),
+        )
+        conn.commit()
+
+
+def heartbeat_jobs(job_ids: Sequence[str]) -> None:
+    """Renew the lease of running jobs so ``requeue_stale_jobs`` leaves them alone."""
+    if not job_ids:
+        return
+    heartbeat_at = datetime.utcnow().isoformat()
+    placeholders = ",".join("?" * len(job_ids))
+    with _connect() as conn:
+        conn.execute(
+            f"UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND id IN ({placeholders})",
+            (heartbeat_at, *job_ids),
+        )
+        conn.commit()
+
+
+def requeue_stale_jobs(lease_seconds: float) -> int:
+    """Put running jobs whose lease lapsed (their process died) back on the queue; returns how many."""
+    cutoff = (datetime.utcnow() - timedelta(seconds=lease_seconds)).isoformat()
+    with _connect() as conn:
+        cursor = conn.execute(
+            """
+            UPDATE jobs SET status = 'queued', started_at = NULL, heartbeat_at = NULL
+            WHERE status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)
+            """,
+            (cutoff,),
+        )
+        conn.commit()
+        return cursor.rowcount
@@ -0,0 +1,168 @@
+import asyncio
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from app import jobs
+from app.analysis import ReferenceSnapshot, _Progress, _run_stages, result_cache_key
+from app.config import settings
+from app.executor import BoundedExecutor, QueueFullError
+from app.storage import (
+    add_reference,
+    claim_job,
+    count_jobs,
+    create_session,
+    get_cached_result,
+    get_session,
+    heartbeat_jobs,
+    init_db,
+    put_cached_result,
+    requeue_stale_jobs,
+)
+
+
+def test_run_stages_overlaps_independent_chains_and_keeps_progress_monotonic() -> None:
+    reported = []
+    both_started = threading.Barrier(2, timeout=5)
+
+    def chain_start(value: int) -> int:
+        both_started.wait()
+        time.sleep(0.05)
+        return value
+
+    started = time.perf_counter()
+    results = _run_stages(
+        {
+            "match": (lambda: chain_start(1), []),
+            "ocr": (lambda: chain_start(2), []),
+            "layout": (lambda match: match * 10, ["match"]),
+            "typography": (lambda ocr: ocr * 10, ["ocr"]),
+        },
+        _Progress(lambda status, percent: reported.append(percent)),
+        {},
+    )
+    elapsed = time.perf_counter() - started
+
+    assert results == {"match": 1, "ocr": 2, "layout": 10, "typography": 20}
+    assert elapsed < 0.1
+    assert reported == sorted(set(reported))
+
+
+def test_reference_snapshot_flags_field_zones_only_when_declared() -> None:
+    plain = {"id": "a", "metadata": "{}"}
+    zoned = {"id": "b", "metadata": '{"field_zones": {"document_number": {"x": 0.1, "y": 0.1, "w": 0.3, "h": 0.05}}}'}
+
+    assert not ReferenceSnapshot(rows=[plain], stamp="1").field_zones
+    assert ReferenceSnapshot(rows=[plain, zoned], stamp="2").field_zones
+
+
+def test_result_cache_honours_key_cap_and_reference_changes(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "cache.db"))
+    init_db()
+    frame = np.full((60, 80, 3), 200, dtype=np.uint8)
+    key = result_cache_key(frame, "NCS_ORIGIN", None)
+
+    assert key != result_cache_key(frame, "NCS_ORIGIN", "v2")
+    put_cached_result(key, {"value": 1}, ttl_seconds=60, max_entries=2)
+    assert get_cached_result(key, ttl_seconds=60) == {"value": 1}
+
+    put_cached_result("b", {"value": 2}, ttl_seconds=60, max_entries=2)
+    put_cached_result("c", {"value": 3}, ttl_seconds=60, max_entries=2)
+    assert get_cached_result(key, ttl_seconds=60) is None
+
+    add_reference("ref", "NCS_ORIGIN", "v1", {}, str(tmp_path / "ref.jpg"))
+    assert result_cache_key(frame, "NCS_ORIGIN", None) != key
+
+
+def test_bounded_executor_rejects_beyond_queue_and_reports_stats() -> None:
+    executor = BoundedExecutor(workers=1, max_queue=1, name="test-pipeline")
+    release = threading.Event()
+
+    async def scenario() -> list:
+        running = executor.submit(release.wait, 5)
+        queued = executor.submit(lambda: "queued")
+        with pytest.raises(QueueFullError) as excinfo:
+            executor.submit(lambda: "rejected")
+        assert excinfo.value.retry_after >= 1
+        release.set()
+        return [await running, await queued]
+
+    assert asyncio.run(scenario()) == [True, "queued"]
+    stats = executor.stats()
+    assert stats["completed"] == 2
+    assert stats["rejected"] == 1
+    assert stats["running"] == 0 and stats["queued"] == 0
+
+
+def test_bounded_executor_releases_slot_of_cancelled_queued_job() -> None:
+    executor = BoundedExecutor(workers=1, max_queue=1, name="test-pipeline")
+    release = threading.Event()
+
+    async def scenario() -> list:
+        running = executor.submit(release.wait, 5)
+        queued = executor.submit(lambda: "cancelled")
+        queued.cancel()
+        await asyncio.sleep(0)
+        assert executor.stats()["queued"] == 0
+        follow_up = executor.submit(lambda: "follow-up")
+        release.set()
+        return [await running, await follow_up]
+
+    assert asyncio.run(scenario()) == [True, "follow-up"]
+    stats = executor.stats()
+    assert stats["completed"] == 2
+    assert stats["running"] == 0 and stats["queued"] == 0
+
+
+def test_job_workers_drain_queued_frames_into_session(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(settings, "data_dir", str(tmp_path))
+    init_db()
+    create_session("session", "NCS_ORIGIN")
+    calls = []
+    monkeypatch.setattr(jobs, "run_session_frame", lambda *args: calls.append(args))
+
+    _, encoded = cv2.imencode(".png", np.full((40, 60, 3), 200, dtype=np.uint8))
+    job_id = jobs.enqueue_frame_job("session", encoded.tobytes(), "NCS_ORIGIN", None)
+    jobs.enqueue_frame_job("session", b"not an image", "NCS_ORIGIN", None)
+    assert get_session("session")["stage"] == "queued"
+
+    workers = jobs.JobWorkers(1)
+    assert workers.run_next()
+    assert calls[0][0] == "session" and calls[0][1].shape == (40, 60, 3)
+    assert not os.path.exists(os.path.join(str(tmp_path), "jobs", f"{job_id}.upload"))
+
+    assert workers.run_next()
+    assert get_session("session")["stage"] == "error"
+    assert not workers.run_next()
+    assert count_jobs("done") == 1 and count_jobs("error") == 1
+
+
+def test_job_leases_keep_live_jobs_running_and_requeue_lapsed_ones(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(settings, "data_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "job_lease_seconds", 30.0)
+    init_db()
+    create_session("session", "NCS_ORIGIN")
+    lapsed = jobs.enqueue_frame_job("session", b"frame", "NCS_ORIGIN", None)
+    live = jobs.enqueue_frame_job("session", b"frame", "NCS_ORIGIN", None)
+    assert claim_job()["id"] == lapsed
+    time.sleep(0.2)
+    assert claim_job()["id"] == live
+
+    # Another process holding a fresh lease keeps its job across a restart here.
+    workers = jobs.JobWorkers(1)
+    monkeypatch.setattr(workers, "run_next", lambda: False)
+    workers.start()
+    workers.stop()
+    assert count_jobs("running") == 2
+
+    assert requeue_stale_jobs(0.1) == 1
+    assert claim_job()["id"] == lapsed
+    time.sleep(0.2)
+    heartbeat_jobs([live, lapsed])
+    assert requeue_stale_jobs(0.1) == 0
@@ -1,4 +1,9 @@
+import asyncio
 import io
+import json
+import threading
+import time
+from typing import List
 
 import cv2
 import numpy as np
@@ -6,7 +11,13 @@ import pytest
 from fastapi.testclient import TestClient
 import pytesseract
 
+from app import analysis, api
+from app.config import settings
+from app.events import set_session_result, set_session_status
+from app.executor import BoundedExecutor
 from app.main import create_app
+from app.pipeline.ocr import OCREngine, OCRWord
+from app.storage import init_db
 
 
 def _tesseract_available() -> bool:
@@ -37,3 +48,110 @@ def test_session_flow() -> None:
         payload = response.json()
         assert "result" in payload
         assert "summary" in payload["result"]
+
+
+def test_session_events_stream_pushes_progress_and_result(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "events.db"))
+    init_db()
+    client = TestClient(create_app())
+    session_id = client.post("/v1/sessions", json={}).json()["id"]
+
+    def publish() -> None:
+        time.sleep(0.2)
+        set_session_status(session_id, "matching", 40)
+        set_session_result(session_id, {"summary": {"match_score": 91.0}})
+
+    threading.Thread(target=publish).start()
+    events = []
+    with client.stream("GET", f"/v1/sessions/{session_id}/events") as response:
+        assert response.headers["content-type"].startswith("text/event-stream")
+        for line in response.iter_lines():
+            if line.startswith("event: "):
+                events.append(line[len("event: "):])
+            elif line.startswith("data: "):
+                events.append(json.loads(line[len("data: "):]))
+
+    assert events[0] == "status" and events[1]["stage"] == "queued"
+    assert [event["stage"] for event in events[3:-2:2]] == ["matching", "done"]
+    assert events[-2] == "result" and events[-1]["result"]["summary"]["match_score"] == 91.0
+
+    replay = client.get(f"/v1/sessions/{session_id}/events").text
+    assert replay.count("event: ") == 2 and "event: result" in replay
+    assert client.get("/v1/sessions/missing/events").status_code == 404
+
+
+def test_stream_selects_stable_frame_then_reports_status_and_result(tmp_path, monkeypatch) -> None:
+    class NoTextEngine(OCREngine):
+        def recognize(self, image: np.ndarray, psm: int = 3, whitelist: str = "") -> List[OCRWord]:
+            return []
+
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "stream.db"))
+    monkeypatch.setattr(settings, "result_cache_ttl_seconds", 0)
+    monkeypatch.setattr(analysis, "get_ocr_engine", NoTextEngine)
+    init_db()
+    client = TestClient(create_app())
+    session_id = client.post("/v1/sessions", json={}).json()["id"]
+
+    def preview(offset: int) -> bytes:
+        frame = np.full((480, 640, 3), 40, dtype=np.uint8)
+        frame[60:420, 100 + offset:500 + offset] = 230
+        cv2.putText(frame, "NCS ORIGIN", (140 + offset, 200), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+        return cv2.imencode(".jpg", frame)[1].tobytes()
+
+    messages = []
+    with client.websocket_connect(f"/v1/sessions/{session_id}/stream") as websocket:
+        websocket.send_bytes(b"not an image")
+        messages.append(websocket.receive_json())
+        for offset in (0, 60, 60, 60, 60):
+            websocket.send_bytes(preview(offset))
+            messages.append(websocket.receive_json())
+            if messages[-1]["stable_frames"] >= settings.stream_stable_frames:
+                break
+        while messages[-1]["type"] not in ("result", "error"):
+            messages.append(websocket.receive_json())
+
+    types = [message["type"] for message in messages]
+    assert messages[0] == {"type": "error", "status": 400, "detail": "Unsupported image format"}
+    assert [message["stable_frames"] for message in messages[1:6]] == [1, 0, 1, 2, 3]
+    selected = messages[6]
+    assert selected["type"] == "selected" and selected["index"] in (2, 3, 4) and selected["frames"] == 5
+    stages = [message["stage"] for message in messages if message["type"] == "status"]
+    assert stages[0] == "rectifying" and stages[-1] == "done"
+    assert types[-1] == "result" and messages[-1]["session_id"] == session_id
+    assert client.get(f"/v1/sessions/{session_id}/status").json()["stage"] == "done"
+
+
+def test_cached_frame_is_answered_while_pipeline_is_full(tmp_path, monkeypatch) -> None:
+    class NoTextEngine(OCREngine):
+        def recognize(self, image: np.ndarray, psm: int = 3, whitelist: str = "") -> List[OCRWord]:
+            return []
+
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "cache.db"))
+    monkeypatch.setattr(analysis, "get_ocr_engine", NoTextEngine)
+    executor = BoundedExecutor(workers=1, max_queue=0, name="test-pipeline")
+    monkeypatch.setattr(api, "pipeline_executor", executor)
+    init_db()
+    client = TestClient(create_app())
+    session_id = client.post("/v1/sessions", json={}).json()["id"]
+
+    def upload(offset: int) -> dict:
+        frame = np.full((480, 640, 3), 40, dtype=np.uint8)
+        frame[60:420, 100 + offset:500 + offset] = 230
+        cv2.putText(frame, "NCS ORIGIN", (140 + offset, 200), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+        return {"file": ("frame.jpg", io.BytesIO(cv2.imencode(".jpg", frame)[1].tobytes()), "image/jpeg")}
+
+    first = client.post(f"/v1/sessions/{session_id}/frame", files=upload(0))
+    release = threading.Event()
+    threading.Thread(target=lambda: asyncio.run(executor.run(release.wait, 5))).start()
+    while executor.stats()["running"] == 0:
+        time.sleep(0.01)
+    try:
+        repeated = client.post(f"/v1/sessions/{session_id}/frame", files=upload(0))
+        fresh = client.post(f"/v1/sessions/{session_id}/frame", files=upload(20))
+    finally:
+        release.set()
+
+    assert first.status_code == 200
+    assert repeated.status_code == 200 and repeated.json()["result"] == first.json()["result"]
+    assert fresh.status_code == 429
+    assert executor.stats()["completed"] <= 2 and executor.stats()["rejected"] == 1
@@ -1,11 +1,35 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 import cv2
 import numpy as np
+import pytest
+from skimage.metrics import structural_similarity
 
-from app.pipeline.match import compute_match_score
-from app.pipeline.quality import assess_quality
+from app.config import settings
+from app.pipeline.frame import FrameContext
+from app.pipeline.match import (
+    KeypointIndex,
+    compute_match_score,
+    extract_keypoints,
+    match_reference,
+    prepare_reference,
+)
+from app.pipeline.ocr import (
+    FIELD_DEFAULTS,
+    OCREngine,
+    OCRWord,
+    create_ocr_engine,
+    ocr_quality_score,
+    run_ocr,
+    run_zone_ocr,
+)
+from app.pipeline.quality import assess_quality, recapture_hints
 from app.pipeline.rectify import rectify_document
+from app.pipeline.ssim import batch_ssim
+from app.pipeline.stability import FrameSelector
+from app.pipeline.tamper import analyze_layout, analyze_tamper, analyze_typography, combine_tamper
 
 
 TEST_IMAGE_PATH = os.environ.get("NCS_TEST_IMAGE", "server/data/sample.jpg")
@@ -25,3 +49,363 @@ def test_pipeline_smoke() -> None:
 
     assert quality.blur_score >= 0
     assert score >= 90.0
+
+
+def test_match_reference_shortlist_keeps_best_candidate() -> None:
+    rng = np.random.default_rng(7)
+    images = [rng.integers(0, 255, size=(300, 400, 3), dtype=np.uint8) for _ in range(6)]
+    references = [(str(idx), prepare_reference(img)) for idx, img in enumerate(images)]
+
+    best = match_reference(images[4], references, shortlist_k=2)
+
+    assert best is not None
+    assert best.reference_id == "4"
+    assert best.score >= 99.0
+
+
+def test_batch_ssim_matches_skimage() -> None:
+    rng = np.random.default_rng(11)
+    query = cv2.GaussianBlur(rng.integers(0, 255, size=(240, 320), dtype=np.uint8), (5, 5), 2)
+    references = [
+        cv2.GaussianBlur(rng.integers(0, 255, size=(height, 320), dtype=np.uint8), (5, 5), 2)
+        for height in (200, 240, 300)
+    ]
+    references.append(query.copy())
+
+    scores = batch_ssim(query, references)
+
+    for score, reference in zip(scores, references):
+        rows = min(query.shape[0], reference.shape[0])
+        expected = structural_similarity(query[:rows], reference[:rows])
+        assert abs(score - expected) < 1e-5
+
+
+def test_match_reference_pyramid_prunes_distant_candidates() -> None:
+    rng = np.random.default_rng(3)
+    images = [cv2.GaussianBlur(rng.integers(0, 255, size=(300, 400, 3), dtype=np.uint8), (9, 9), 4) for _ in range(5)]
+    references = [(str(idx), prepare_reference(img)) for idx, img in enumerate(images)]
+
+    best = match_reference(images[2], references, pyramid_levels=3, prune_margin=10.0)
+
+    assert best is not None
+    assert best.reference_id == "2"
+    assert [level.width for level in best.levels] == [200, 800]
+    assert best.levels[0].pruned == 4
+    assert best.levels[-1].scored == 1
+
+
+def test_match_reference_parallel_matches_sequential_with_ties() -> None:
+    rng = np.random.default_rng(5)
+    images = [rng.integers(0, 255, size=(300, 400, 3), dtype=np.uint8) for _ in range(7)]
+    references = [(str(idx), prepare_reference(img)) for idx, img in enumerate(images)]
+    references.append(("duplicate", references[3][1]))
+
+    sequential = match_reference(images[3], references)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        parallel = match_reference(images[3], references, executor=executor, workers=3)
+
+    assert sequential is not None and parallel is not None
+    assert parallel.reference_id == sequential.reference_id == "3"
+    assert parallel.score == sequential.score
+
+
+def _keypoint_page(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return cv2.GaussianBlur(rng.integers(0, 255, size=(600, 800), dtype=np.uint8), (3, 3), 1)
+
+
+def test_keypoint_index_save_load_and_match(tmp_path) -> None:
+    path = str(tmp_path / "keypoints")
+    index = KeypointIndex(path)
+    for seed in range(3):
+        index.add(str(seed), extract_keypoints(_keypoint_page(seed)))
+
+    reloaded = KeypointIndex(path)
+    reloaded.load()
+    frame = cv2.cvtColor(_keypoint_page(1), cv2.COLOR_GRAY2BGR)
+    candidate = reloaded.match(frame)
+
+    assert len(reloaded) == 3
+    assert candidate is not None and candidate.reference_id == "1"
+    restricted = reloaded.match(frame, allowed_ids=["0", "2"])
+    assert restricted is None or restricted.reference_id != "1"
+
+
+def test_keypoint_index_matches_near_duplicate_references(tmp_path) -> None:
+    index = KeypointIndex(str(tmp_path / "keypoints"))
+    for ref_id, seed in (("0", 0), ("1", 1), ("1-copy", 1), ("2", 2)):
+        index.add(ref_id, extract_keypoints(_keypoint_page(seed)))
+    frame = cv2.cvtColor(_keypoint_page(1), cv2.COLOR_GRAY2BGR)
+
+    unrestricted = index.match(frame)
+    exact = index.match(frame, allowed_ids=["0", "1"])
+    indexed = index.match(frame, allowed_ids=["1"] + [f"missing-{n}" for n in range(40)])
+
+    assert unrestricted is not None and unrestricted.reference_id in ("1", "1-copy")
+    assert unrestricted.score > 50.0
+    for candidate in (exact, indexed):
+        assert candidate is not None and candidate.reference_id == "1" and candidate.score > 50.0
+
+
+def test_keypoint_index_concurrent_adds_keep_every_reference(tmp_path) -> None:
+    path = str(tmp_path / "keypoints")
+    first, second = KeypointIndex(path), KeypointIndex(path)
+    first.add("a", extract_keypoints(_keypoint_page(1)))
+    second.add("b", extract_keypoints(_keypoint_page(2)))
+
+    features = extract_keypoints(_keypoint_page(3))
+    indexes = [KeypointIndex(path) for _ in range(4)]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda pair: pair[1].add(f"t{pair[0]}", features), enumerate(indexes)))
+
+    reloaded = KeypointIndex(path)
+    reloaded.load()
+    assert sorted(reloaded._ids) == ["a", "b", "t0", "t1", "t2", "t3"]
+
+
+def test_analyze_tamper_flags_only_changed_cell() -> None:
+    rng = np.random.default_rng(9)
+    reference = cv2.GaussianBlur(rng.integers(0, 255, size=(600, 800, 3), dtype=np.uint8), (5, 5), 2)
+    frame = reference.copy()
+    frame[110:190, 210:290] = 255
+
+    result = analyze_tamper(frame, prepare_reference(reference), {}, [])
+
+    assert [finding.bbox for finding in result.findings] == [[200, 100, 100, 100]]
+
+
+def test_analyze_tamper_adaptive_mode_tightens_boxes() -> None:
+    rng = np.random.default_rng(9)
+    reference = cv2.GaussianBlur(rng.integers(0, 255, size=(900, 1200, 3), dtype=np.uint8), (5, 5), 2)
+    frame = reference.copy()
+    frame[300:340, 140:700] = 255
+
+    grid = analyze_tamper(frame, prepare_reference(reference), {}, [])
+    adaptive = analyze_tamper(frame, prepare_reference(reference), {}, [], mode="adaptive")
+
+    assert grid.findings == []
+    boxes = [finding.bbox for finding in adaptive.findings]
+    assert boxes
+    assert all(y >= 250 and y + h <= 400 and x >= 100 and x + w <= 750 for x, y, w, h in boxes)
+    assert min(x for x, _, _, _ in boxes) <= 150 and max(x + w for x, _, w, _ in boxes) >= 690
+
+
+def test_analyze_tamper_adaptive_mode_flags_single_changed_glyph() -> None:
+    def page(number: str) -> np.ndarray:
+        image = np.full((1697, 1200, 3), 255, dtype=np.uint8)
+        for line in range(40):
+            text = f"Line {line:02d} of the certificate body text"
+            cv2.putText(image, text, (80, 120 + line * 38), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+        cv2.putText(image, f"Document No. {number}", (80, 1640), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+        return image
+
+    def recapture(image: np.ndarray) -> np.ndarray:
+        height, width = image.shape[:2]
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), 0.2, 1.0)
+        matrix[:, 2] += (0.5, 0.5)
+        moved = cv2.warpAffine(image, matrix, (width, height), borderMode=cv2.BORDER_REPLICATE)
+        _, encoded = cv2.imencode(".jpg", moved, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        return cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+
+    reference = prepare_reference(page("NCS-2024-004817"))
+    frame = page("NCS-2024-004818")
+
+    grid = analyze_tamper(frame, reference, {}, [])
+    adaptive = analyze_tamper(frame, reference, {}, [], mode="adaptive")
+    untouched = analyze_tamper(page("NCS-2024-004817"), reference, {}, [], mode="adaptive")
+    recaptured = analyze_tamper(recapture(page("NCS-2024-004817")), reference, {}, [], mode="adaptive")
+
+    assert grid.findings == [] and untouched.findings == [] and recaptured.findings == []
+    assert len(adaptive.findings) == 1
+    x, y, w, h = adaptive.findings[0].bbox
+    assert x <= 510 and y <= 1630 and x + w >= 520 and y + h >= 1640
+    assert w < 150 and h < 150
+
+
+def test_tamper_split_matches_combined_analysis() -> None:
+    reference = np.full((600, 800, 3), 255, dtype=np.uint8)
+    cv2.rectangle(reference, (100, 100), (300, 200), (0, 0, 0), -1)
+    frame = reference.copy()
+    cv2.rectangle(frame, (500, 350), (700, 450), (0, 0, 0), -1)
+    prepared = prepare_reference(reference)
+    boxes = [[10, 10, 40, 8], [60, 10, 40, 60], [10, 90, 40, 9]]
+
+    combined = analyze_tamper(frame, prepared, {}, boxes)
+    split = combine_tamper(analyze_layout(frame, prepared, {}), analyze_typography(boxes))
+
+    assert split == combined
+    assert {finding.category for finding in split.findings} == {"layout", "typography"}
+
+
+def test_run_ocr_uses_given_engine() -> None:
+    class FixedEngine(OCREngine):
+        def recognize(self, image: np.ndarray) -> List[OCRWord]:
+            return [
+                OCRWord(text="NCS123456", conf=90.0, bbox=[5, 5, 80, 12]),
+                OCRWord(text="2024-01-31", conf=88.0, bbox=[5, 20, 70, 12]),
+            ]
+
+    result = run_ocr(np.zeros((40, 120, 3), dtype=np.uint8), FixedEngine())
+
+    assert result.full_text == "NCS123456\n2024-01-31"
+    assert result.extracted_fields == {"document_number": "NCS123456", "dates": "2024-01-31"}
+    assert create_ocr_engine("pytesseract").name == "pytesseract"
+    assert create_ocr_engine("auto").name in ("tesserocr", "pytesseract")
+    with pytest.raises(TypeError):
+        OCREngine()
+
+
+def test_zone_ocr_reads_only_field_crops() -> None:
+    calls = []
+
+    class RecordingEngine(OCREngine):
+        def recognize(self, image: np.ndarray, psm: int = 3, whitelist: str = "") -> List[OCRWord]:
+            calls.append((image.shape[:2], psm, whitelist))
+            return [OCRWord(text=f"w{len(calls)}", conf=90.0, bbox=[2, 3, 10, 8])]
+
+    page = np.zeros((1000, 1200, 3), dtype=np.uint8)
+    zones = {
+        "document_number": {"x": 0.5, "y": 0.1, "w": 0.25, "h": 0.05},
+        "exporter": {"x": 100, "y": 400, "w": 300, "h": 80, "psm": 4},
+    }
+
+    result = run_zone_ocr(page, zones, RecordingEngine())
+
+    assert calls == [((62, 312), 7, FIELD_DEFAULTS["document_number"][0]), ((92, 312), 4, "")]
+    assert result.extracted_fields == {"document_number": "w1", "exporter": "w2"}
+    assert result.words[0].bbox == [596, 97, 10, 8]
+    assert result.words[1].bbox == [96, 397, 10, 8]
+    assert ocr_quality_score(result, zones) == 100.0
+    assert ocr_quality_score(result) == 3.0
+
+
+def test_tiled_ocr_matches_full_page_words() -> None:
+    page_words = [(f"w{row}", [40, 30 + row * 45, 120, 24]) for row in range(20)]
+
+    class PageEngine(OCREngine):
+        def recognize(self, image: np.ndarray, psm: int = 3, whitelist: str = "") -> List[OCRWord]:
+            top = int(image[0, 0, 1]) * 256 + int(image[0, 0, 0])
+            return [
+                OCRWord(text=text, conf=90.0, bbox=[x, y - top, w, h])
+                for text, (x, y, w, h) in page_words
+                if top <= y and y + h <= top + image.shape[0]
+            ]
+
+    page = np.zeros((960, 400, 3), dtype=np.uint8)
+    page[:, :, 0] = (np.arange(960) % 256)[:, None]
+    page[:, :, 1] = (np.arange(960) // 256)[:, None]
+
+    full = run_ocr(page, PageEngine())
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tiled = run_ocr(page, PageEngine(), tiles=4, overlap=64, executor=executor)
+
+    assert [word.text for word in full.words] == [text for text, _ in page_words]
+    assert tiled == full
+
+
+def test_quality_hints_flag_blurred_frames() -> None:
+    frame = np.full((480, 640, 3), 180, dtype=np.uint8)
+    cv2.putText(frame, "NCS ORIGIN 123456", (40, 240), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0), 3)
+
+    sharp = assess_quality(frame)
+    blurred = assess_quality(cv2.GaussianBlur(frame, (31, 31), 10))
+
+    assert recapture_hints(sharp, min_blur=30.0, max_glare=0.6) == []
+    assert [hint["code"] for hint in recapture_hints(blurred, min_blur=30.0, max_glare=0.6)] == ["blur"]
+
+
+def test_downscaled_rectify_matches_full_resolution_detection() -> None:
+    photo = np.full((3000, 4000, 3), 40, dtype=np.uint8)
+    corners = np.array([[620, 410], [3420, 520], [3330, 2600], [540, 2480]], dtype=np.int32)
+    cv2.fillConvexPoly(photo, corners, (235, 235, 235))
+    for row in range(12):
+        y = 700 + row * 140
+        cv2.putText(photo, f"LINE {row} EXPORTER 12345", (800, y), cv2.FONT_HERSHEY_SIMPLEX, 3, (0, 0, 0), 6)
+
+    full = rectify_document(photo, detect_max_side=4000)
+    fast = rectify_document(photo, detect_max_side=800, refine_corners=True)
+
+    assert full.success and fast.success
+    assert abs(full.image.shape[0] - fast.image.shape[0]) <= 3
+    height = min(full.image.shape[0], fast.image.shape[0])
+    diff = cv2.absdiff(full.image[:height], fast.image[:height])
+    assert float(diff.mean()) < 6.0
+
+    match_view = fast.warp(800, 600)
+    assert match_view.shape == (600, 800, 3)
+    assert float(cv2.absdiff(match_view, cv2.resize(fast.image, (800, 600))).mean()) < 6.0
+
+
+def test_default_rectify_settings_match_as_well_as_full_resolution_detection() -> None:
+    page = np.full((600, 850, 3), 235, dtype=np.uint8)
+    for row in range(7):
+        y = 80 + row * 75
+        cv2.putText(page, f"LINE {row} EXPORTER 12345", (60, y), cv2.FONT_HERSHEY_SIMPLEX, 1.1, (0, 0, 0), 2)
+    source = np.float32([[0, 0], [849, 0], [849, 599], [0, 599]])
+    corners = np.float32([[620, 410], [3420, 520], [3330, 2600], [540, 2480]])
+    transform = cv2.getPerspectiveTransform(source, corners)
+    photo = cv2.warpPerspective(page, transform, (4000, 3000), borderValue=(40, 40, 40))
+
+    default = rectify_document(
+        photo, detect_max_side=settings.rectify_max_side, refine_corners=settings.rectify_refine_corners
+    )
+    full = rectify_document(photo, detect_max_side=4000)
+
+    assert settings.rectify_refine_corners
+    assert default.success and full.success
+    full_score = compute_match_score(full.image, page)
+    assert full_score > 70.0
+    assert abs(compute_match_score(default.image, page) - full_score) < 0.5
+
+
+def test_rectify_warp_at_page_size_equals_rectified_image() -> None:
+    photo = np.full((900, 1200, 3), 40, dtype=np.uint8)
+    corners = np.array([[180, 120], [1010, 150], [990, 800], [160, 770]], dtype=np.int32)
+    cv2.fillConvexPoly(photo, corners, (235, 235, 235))
+    cv2.putText(photo, "NCS ORIGIN 123456", (260, 400), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 0, 0), 4)
+
+    result = rectify_document(photo)
+    height, width = result.image.shape[:2]
+
+    assert result.success and width == 1200
+    np.testing.assert_array_equal(result.warp(width, height), result.image)
+
+
+def test_frame_context_memoizes_views_and_matches_plain_path() -> None:
+    reference = np.full((900, 1200, 3), 230, dtype=np.uint8)
+    cv2.putText(reference, "NCS ORIGIN", (100, 300), cv2.FONT_HERSHEY_SIMPLEX, 4, (0, 0, 0), 8)
+    frame = cv2.GaussianBlur(reference, (3, 3), 0)
+    references = [("ref", prepare_reference(reference))]
+    context = FrameContext(frame)
+
+    assert context.pyramid(800, 600, 1) is context.pyramid(800, 600, 1)
+    assert context.moments(800, 600) is context.moments(800, 600)
+
+    plain = match_reference(frame, references, pyramid_levels=2)
+    shared = match_reference(frame, references, pyramid_levels=2, context=context)
+    assert abs(plain.score - shared.score) < 0.5
+
+
+def test_frame_selector_waits_for_stable_corners_and_keeps_sharpest_frame() -> None:
+    def preview(offset: int, blur: int = 0) -> np.ndarray:
+        frame = np.full((480, 640, 3), 40, dtype=np.uint8)
+        cv2.rectangle(frame, (80 + offset, 60), (560 + offset, 420), (230, 230, 230), -1)
+        for row in range(6):
+            cv2.putText(frame, f"LINE {row} 12345", (120 + offset, 110 + row * 50), 0, 1, (0, 0, 0), 2)
+        return cv2.GaussianBlur(frame, (2 * blur + 1, 2 * blur + 1), 0) if blur else frame
+
+    selector = FrameSelector(min_blur=30.0, max_glare=0.6, stable_frames=3, corner_tolerance=0.02)
+    checks = [
+        selector.add(np.zeros((480, 640, 3), dtype=np.uint8), "empty"),
+        selector.add(preview(0), "first"),
+        selector.add(preview(60), "moved"),
+        selector.add(preview(61, blur=1), "soft"),
+        selector.add(preview(60), "sharp"),
+    ]
+
+    assert [check.corners_found for check in checks] == [False, True, True, True, True]
+    assert "motion" in [hint["code"] for hint in checks[2].hints]
+    assert [check.stable_frames for check in checks] == [0, 1, 0, 1, 2]
+    assert not checks[-1].ready
+    assert selector.add(preview(60, blur=1), "last").ready
+    assert selector.best().payload == "sharp"
@@ -0,0 +1,223 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from app.config import settings
+from app.feature_store import FeatureStore, feature_store
+from app.pipeline.match import DESCRIPTOR_SIZE, KeypointIndex, PreparedReference
+from app import reference_cache as reference_cache_module
+from app.reference_cache import (
+    ReferenceCache,
+    descriptor_index,
+    keypoint_index,
+    match_frame,
+    moments_cache,
+    pyramid_cache,
+    reference_cache,
+    register_reference,
+    warm_reference_cache,
+)
+from app.storage import add_reference, init_db, list_references
+
+
+def _prepared() -> PreparedReference:
+    return PreparedReference(gray=np.zeros(92, dtype=np.uint8), descriptor=np.zeros(2, dtype=np.float32))
+
+
+def test_reference_cache_evicts_least_recently_used() -> None:
+    cache = ReferenceCache(max_bytes=250, loader=lambda row: None)
+    cache.put("a", _prepared())
+    cache.put("b", _prepared())
+    assert cache.get("a") is not None
+
+    cache.put("c", _prepared())
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.nbytes == 200
+
+
+def test_feature_store_round_trips_arrays_across_a_remap(tmp_path) -> None:
+    path = str(tmp_path / "features.bin")
+    store, other_worker = FeatureStore(path), FeatureStore(path)
+    gray = np.arange(30 * 41, dtype=np.uint8).reshape(30, 41)
+    first = store.append(gray)
+    first_view = store.view(first, gray.shape)
+
+    moments = np.linspace(0.0, 1.0, 12 * 7, dtype=np.float32).reshape(12, 7)
+    second = other_worker.append(moments)
+    second_view = store.view(second, moments.shape, "float32")
+
+    assert first == 0 and second % 64 == 0 and second >= gray.nbytes
+    np.testing.assert_array_equal(first_view, gray)
+    np.testing.assert_array_equal(second_view, moments)
+    np.testing.assert_array_equal(store.view(first, gray.shape), gray)
+    assert not second_view.flags.writeable
+
+
+def test_list_references_filters_by_doc_type_and_version(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "filter.db"))
+    init_db()
+    for ref_id, doc_type, version in [("a", "NCS_ORIGIN", "v1"), ("b", "NCS_ORIGIN", "v2"), ("c", "NCS_EXPORT", "v1")]:
+        add_reference(ref_id, doc_type, version, {}, str(tmp_path / f"{ref_id}.jpg"))
+
+    def ids(doc_type=None, version=None):
+        return sorted(row["id"] for row in list_references(doc_type, version))
+
+    assert ids() == ["a", "b", "c"]
+    assert ids("NCS_ORIGIN") == ["a", "b"]
+    assert ids(version="v1") == ["a", "c"]
+    assert ids("NCS_ORIGIN", "v2") == ["b"]
+    assert ids("NCS_UNKNOWN") == []
+    with sqlite3.connect(settings.database_path) as conn:
+        plan = conn.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM "references" WHERE doc_type = ? AND version = ?', ("NCS_ORIGIN", "v1")
+        ).fetchall()
+    assert "idx_references_doc_type_version" in str(plan)
+
+
+def _page(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    page = np.full((600, 800, 3), 235, dtype=np.uint8)
+    for row in range(8):
+        x = int(rng.integers(20, 300))
+        cv2.putText(page, f"REF {seed} LINE {row} {rng.integers(1e6)}", (x, 60 + row * 65), 0, 1, (0, 0, 0), 2)
+    return page
+
+
+def test_match_frame_stays_within_budget_when_catalogue_outgrows_cache(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "refs.db"))
+    monkeypatch.setattr(settings, "match_shortlist_k", 2)
+    monkeypatch.setattr(feature_store, "path", str(tmp_path / "features.bin"))
+    monkeypatch.setattr(feature_store, "_map", None)
+    monkeypatch.setattr(keypoint_index, "path", str(tmp_path / "keypoints"))
+    page_bytes = 800 * 600 + DESCRIPTOR_SIZE * DESCRIPTOR_SIZE * 4
+    monkeypatch.setattr(reference_cache, "max_bytes", 3 * page_bytes)
+    monkeypatch.setattr(moments_cache, "max_bytes", 2 * 800 * 600 * 8)
+    reference_cache.clear()
+    moments_cache.clear()
+    init_db()
+    for seed in range(8):
+        add_reference(f"ref-{seed}", "NCS_ORIGIN", "v1", {}, str(tmp_path / f"{seed}.jpg"))
+        register_reference(f"ref-{seed}", _page(seed))
+
+    rows = list_references()
+    for seed in (5, 1, 6):
+        match = match_frame(_page(seed), rows)
+        assert match is not None and match.reference_id == f"ref-{seed}"
+
+    assert len(reference_cache) == 3 and reference_cache.nbytes <= reference_cache.max_bytes
+    assert all(reference_cache.get(row["id"]) is None or reference_cache.get(row["id"]).moments is None for row in rows)
+    assert reference_cache.nbytes == 3 * page_bytes
+    assert len(moments_cache) <= 2 and moments_cache.nbytes <= moments_cache.max_bytes
+    reference_cache.clear()
+    moments_cache.clear()
+
+
+def test_match_frame_loads_only_the_descriptor_shortlist(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "refs.db"))
+    monkeypatch.setattr(settings, "match_shortlist_k", 3)
+    monkeypatch.setattr(feature_store, "path", str(tmp_path / "features.bin"))
+    monkeypatch.setattr(feature_store, "_map", None)
+    monkeypatch.setattr(keypoint_index, "path", str(tmp_path / "keypoints"))
+    init_db()
+    for seed in range(10):
+        add_reference(f"ref-{seed}", "NCS_ORIGIN", "v1", {}, str(tmp_path / f"{seed}.jpg"))
+        register_reference(f"ref-{seed}", _page(seed))
+    # As in a worker that did not register these references itself.
+    reference_cache.clear()
+    descriptor_index.clear()
+
+    match = match_frame(_page(7), list_references())
+
+    assert match is not None and match.reference_id == "ref-7"
+    assert match.levels[0].scored == 10 and match.levels[0].pruned == 7
+    assert len(reference_cache) == 3
+    assert len(descriptor_index) == 10
+    reference_cache.clear()
+    moments_cache.clear()
+
+
+def test_keypoint_index_is_kept_only_for_orb_and_backfilled_at_warm_up(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "refs.db"))
+    monkeypatch.setattr(feature_store, "path", str(tmp_path / "features.bin"))
+    monkeypatch.setattr(feature_store, "_map", None)
+    index_path = str(tmp_path / "keypoints")
+    monkeypatch.setattr("app.reference_cache.keypoint_index", KeypointIndex(index_path))
+    init_db()
+    for seed in range(3):
+        add_reference(f"ref-{seed}", "NCS_ORIGIN", "v1", {}, str(tmp_path / f"{seed}.jpg"))
+        register_reference(f"ref-{seed}", _page(seed))
+    assert not os.path.exists(index_path)
+
+    monkeypatch.setattr(settings, "match_engine", "orb")
+    warm_reference_cache()
+    add_reference("ref-3", "NCS_ORIGIN", "v1", {}, str(tmp_path / "3.jpg"))
+    register_reference("ref-3", _page(3))
+
+    assert len(os.listdir(index_path)) == 4
+    match = match_frame(_page(1), list_references())
+    assert match is not None and match.reference_id == "ref-1"
+    reloaded = KeypointIndex(index_path)
+    reloaded.load()
+    assert sorted(reloaded._ids) == ["ref-0", "ref-1", "ref-2", "ref-3"]
+    reference_cache.clear()
+    moments_cache.clear()
+
+
+def test_warm_up_packs_image_only_references_into_feature_store_once(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "refs.db"))
+    monkeypatch.setattr(feature_store, "path", str(tmp_path / "features.bin"))
+    monkeypatch.setattr(feature_store, "_map", None)
+    init_db()
+    for seed in range(3):
+        path = str(tmp_path / f"{seed}.png")
+        cv2.imwrite(path, _page(seed))
+        add_reference(f"ref-{seed}", "NCS_ORIGIN", "v1", {}, path)
+    reference_cache.clear()
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        list(pool.map(lambda _: warm_reference_cache(), range(3)))
+    size = os.path.getsize(feature_store.path)
+    warm_reference_cache()
+
+    rows = list_references()
+    assert all(row["feature_offset"] is not None for row in rows)
+    assert len({row["feature_offset"] for row in rows}) == 3
+    assert os.path.getsize(feature_store.path) == size <= 3 * (800 * 600 + 64)
+    reference_cache.clear()
+    moments_cache.clear()
+
+
+def test_match_frame_reuses_cached_reference_pyramid_levels(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "database_path", str(tmp_path / "refs.db"))
+    monkeypatch.setattr(settings, "match_pyramid_levels", 3)
+    monkeypatch.setattr(settings, "match_shortlist_k", 0)
+    monkeypatch.setattr(feature_store, "path", str(tmp_path / "features.bin"))
+    monkeypatch.setattr(feature_store, "_map", None)
+    pyramid_cache.clear()
+    init_db()
+    for seed in range(4):
+        add_reference(f"ref-{seed}", "NCS_ORIGIN", "v1", {}, str(tmp_path / f"{seed}.jpg"))
+        register_reference(f"ref-{seed}", _page(seed))
+    calls = []
+    pyramid_level = reference_cache_module.pyramid_level
+    monkeypatch.setattr(
+        reference_cache_module, "pyramid_level", lambda gray, level: calls.append(level) or pyramid_level(gray, level)
+    )
+
+    rows = list_references()
+    first = match_frame(_page(2), rows)
+    built = len(calls)
+    second = match_frame(_page(2), rows)
+
+    assert first is not None and first.reference_id == "ref-2" and second == first
+    assert built == 8 and len(calls) == built
+    assert len(pyramid_cache) == 8
+    pyramid_cache.clear()
+    reference_cache.clear()
+    moments_cache.clear()